@@ -1,5 +1,6 @@
 import os
 import hmac
+import json
 import re
 import time
 from datetime import datetime, timedelta
@@ -12,15 +13,17 @@ os.environ['TZ'] = 'Etc/GMT-8'
 if hasattr(time, 'tzset'):
     time.tzset()
 
+import click
 from flask import Flask, session, request, jsonify, render_template, redirect, url_for, flash
 from flask_sqlalchemy import SQLAlchemy
 from authlib.integrations.flask_client import OAuth
 from apscheduler.schedulers.background import BackgroundScheduler
 from werkzeug.middleware.proxy_fix import ProxyFix
-from sqlalchemy import extract, or_
+from sqlalchemy import func, tuple_
 
-from models import db, Patient, Appointment, QualtricsResponse, SurveyLinkOverride, SurveyReminderEvent, SurveyReminderEscalation, AppSetting, hash_data
-from services import BaileysClient, generate_google_calendar_link, generate_birthday_card, send_patient_greeting_if_needed
+from models import db, Patient, Appointment, QualtricsResponse, SurveyLinkOverride, SurveyReminderEvent, SurveyReminderEscalation, AppSetting, PatientNameToken, SftpFileMetadata, SftpIngestLedger, OutboundMessage, appointment_reminder_due_at, hash_data, decrypt_cache, name_search_suffixes, name_search_token, normalize_name_for_index
+from services import generate_google_calendar_link, generate_birthday_card
+from outbox import PATIENT_DELETED_REASON, cancel_undelivered, enqueue_greeting_if_needed, enqueue_message, get_outbox_stats, requeue_dead_messages, scrub_patient_messages
 from time_utils import now_gmt8, today_gmt8
 import scheduler_tasks
 
@@ -60,6 +63,9 @@ ADMIN_EMAILS = os.getenv('ADMIN_EMAILS', '').split(',')
 # Clean up whitespace
 ADMIN_EMAILS = [email.strip() for email in ADMIN_EMAILS if email.strip()]
 PID_PATTERN = re.compile(r'^P\d{2}$')
+PATIENT_PAGE_SIZE = 25
+PATIENT_PAGE_SIZE_MAX = 200
+PATIENT_LIST_SORTS = ('id', '-id', 'pid', '-pid')
 
 
 def normalize_pid(pid_value):
@@ -171,19 +177,15 @@ def logout():
 @app.route('/')
 @login_required
 def index():
-    patients = Patient.query.all()
+    patient_count = db.session.query(func.count(Patient.id)).scalar()
     survey_overview = scheduler_tasks.get_sftp_survey_overview()
     staff_alert_numbers_value = get_staff_alert_numbers_value()
     now = today_gmt8()
-    birthday_pending = Patient.query.filter(
-        Patient.birthdate.isnot(None),
-        extract('month', Patient.birthdate) == now.month,
-        extract('day', Patient.birthdate) == now.day,
-        or_(
-            Patient.birthday_card_sent_year.is_(None),
-            Patient.birthday_card_sent_year != now.year,
-        ),
-    ).order_by(Patient.name).all()
+    # Sorted in Python: name is encrypted, so ORDER BY would sort ciphertext.
+    birthday_pending = sorted(
+        scheduler_tasks.get_pending_birthday_patients(now),
+        key=lambda patient: patient.name or '',
+    )
 
     upcoming_appointments = Appointment.query.filter(
         Appointment.date >= now_gmt8().replace(tzinfo=None)
@@ -191,7 +193,8 @@ def index():
 
     return render_template(
         'index.html',
-        patients=patients,
+        patient_count=patient_count,
+        patient_page_size=PATIENT_PAGE_SIZE,
         survey_overview=survey_overview,
         staff_alert_numbers_value=staff_alert_numbers_value,
         birthday_pending=birthday_pending,
@@ -205,12 +208,51 @@ def run_survey_reminders_now():
     """Manually trigger the daily survey reminder job from the dashboard."""
     try:
         scheduler_tasks.send_daily_survey_reminders(app)
-        flash('Survey reminders job completed.', 'success')
+        flash('Survey reminders queued for sending.', 'success')
     except Exception as e:
         flash(f'Error running survey reminders: {str(e)}', 'error')
     return redirect(url_for('index'))
 
 
+@app.route('/admin/plan_reminders', methods=['POST'])
+@login_required
+def plan_reminders_now():
+    """Dry run of the reminder jobs: planned messages and timings, nothing sent or written."""
+    job = request.form.get('job', 'survey')
+    if job == 'appointments':
+        report = scheduler_tasks.send_appointment_reminders(app, plan_only=True)
+    else:
+        report = scheduler_tasks.send_daily_survey_reminders(app, plan_only=True)
+    return jsonify(report)
+
+
+@app.route('/admin/decrypt_cache', methods=['GET'])
+@login_required
+def decrypt_cache_stats():
+    """Hit/miss counters for this worker's decrypted-value cache."""
+    return jsonify(decrypt_cache.stats())
+
+
+@app.route('/admin/decrypt_cache/clear', methods=['POST'])
+@login_required
+def clear_decrypt_cache():
+    decrypt_cache.clear()
+    return jsonify({'status': 'cleared'})
+
+
+@app.route('/admin/outbox', methods=['GET'])
+@login_required
+def outbox_stats():
+    """Queue depth and recent dead-lettered messages (no phone numbers or text)."""
+    return jsonify(get_outbox_stats())
+
+
+@app.route('/admin/outbox/requeue_dead', methods=['POST'])
+@login_required
+def requeue_dead_outbox_messages():
+    return jsonify({'status': 'requeued', 'count': requeue_dead_messages()})
+
+
 @app.route('/survey/link_override', methods=['POST'])
 @login_required
 def save_survey_link_override():
@@ -334,6 +376,9 @@ def add_patient():
 @login_required
 def delete_patient(patient_id):
     patient = Patient.query.get_or_404(patient_id)
+    cancel_undelivered(PATIENT_DELETED_REASON, patient_id=patient_id)
+    # Outbox rows hold the patient's phone number and name; don't keep them.
+    scrub_patient_messages(patient_id)
     Appointment.query.filter_by(patient_id=patient_id).delete()
     SurveyReminderEvent.query.filter_by(patient_id=patient_id).delete()
     SurveyReminderEscalation.query.filter_by(patient_id=patient_id).delete()
@@ -345,6 +390,135 @@ def delete_patient(patient_id):
     flash('Patient data deleted.', 'success')
     return redirect(url_for('index'))
 
+def _list_patients_by_pid(query, descending, after, count, include_unassigned=True):
+    """
+    Up to `count` patients in (pid, id) order after the `after` cursor
+    ((pid, id), pid None for a patient without one). Patients with a PID come
+    first, then those without (reversed when descending). The two groups are
+    read by separate queries on the bare column, so each can walk the pid
+    index instead of sorting on an expression.
+    """
+    after_pid, after_id = after if after is not None else (None, None)
+
+    assigned = query.filter(Patient.pid.isnot(None))
+    if after_pid is not None:
+        cursor_key = tuple_(Patient.pid, Patient.id)
+        assigned = assigned.filter(cursor_key < (after_pid, after_id) if descending else cursor_key > (after_pid, after_id))
+    if descending:
+        assigned = assigned.order_by(Patient.pid.desc(), Patient.id.desc())
+    else:
+        assigned = assigned.order_by(Patient.pid, Patient.id)
+
+    unassigned = query.filter(Patient.pid.is_(None))
+    if after is not None and after_pid is None:
+        unassigned = unassigned.filter(Patient.id < after_id if descending else Patient.id > after_id)
+    unassigned = unassigned.order_by(Patient.id.desc() if descending else Patient.id)
+
+    if descending:
+        # A cursor inside the assigned group means the unassigned one is done.
+        groups = [unassigned, assigned] if after_pid is None else [assigned]
+    else:
+        groups = [unassigned] if after is not None and after_pid is None else [assigned, unassigned]
+    if not include_unassigned:
+        groups = [group for group in groups if group is not unassigned]
+
+    rows = []
+    for group in groups:
+        if len(rows) >= count:
+            break
+        rows += group.limit(count - len(rows)).all()
+    return rows
+
+
+@app.route('/patient/list')
+@login_required
+def list_patients():
+    """
+    Keyset-paginated patient rows for the dashboard table. Only the rows on
+    the requested page are loaded (and therefore decrypted). The cursor is
+    the sort key of the last row returned: "<id>" or "<pid>|<id>" ("|<id>"
+    for a patient without a PID).
+    """
+    sort = request.args.get('sort', 'id')
+    if sort not in PATIENT_LIST_SORTS:
+        return jsonify({'error': f"sort must be one of {', '.join(PATIENT_LIST_SORTS)}"}), 400
+    try:
+        limit = min(max(int(request.args.get('limit', PATIENT_PAGE_SIZE)), 1), PATIENT_PAGE_SIZE_MAX)
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+
+    descending = sort.startswith('-')
+    query = Patient.query
+
+    pid_filter = normalize_pid(request.args.get('pid'))
+    if pid_filter:
+        query = query.filter(Patient.pid.like(f'{pid_filter}%'))
+
+    cursor = (request.args.get('cursor') or '').strip()
+    after = None
+    if cursor:
+        try:
+            if sort.endswith('pid'):
+                cursor_pid, cursor_id = cursor.rsplit('|', 1)
+                after = (cursor_pid or None, int(cursor_id))
+            else:
+                after = int(cursor)
+        except ValueError:
+            return jsonify({'error': 'invalid cursor'}), 400
+
+    if sort.endswith('pid'):
+        rows = _list_patients_by_pid(query, descending, after, limit + 1, include_unassigned=not pid_filter)
+    else:
+        if after is not None:
+            query = query.filter(Patient.id < after if descending else Patient.id > after)
+        order = Patient.id.desc() if descending else Patient.id
+        rows = query.order_by(order).limit(limit + 1).all()
+    page = rows[:limit]
+
+    next_cursor = None
+    if len(rows) > limit:
+        last = page[-1]
+        next_cursor = f"{last.pid or ''}|{last.id}" if sort.endswith('pid') else str(last.id)
+
+    return jsonify({
+        'patients': [
+            {
+                'id': patient.id,
+                'pid': patient.pid,
+                'name': patient.name,
+                'phone': patient.phone_number,
+                'birthdate': patient.birthdate.strftime('%Y-%m-%d') if patient.birthdate else None,
+            }
+            for patient in page
+        ],
+        'next_cursor': next_cursor,
+    })
+
+
+@app.route('/patient/search')
+@login_required
+def search_patients():
+    """Name search answered from the blind index instead of decrypting every row."""
+    query = (request.args.get('q') or '').strip()
+    token = name_search_token(query)
+    if not token:
+        return jsonify({'results': []})
+
+    candidates = Patient.query.join(
+        PatientNameToken, PatientNameToken.patient_id == Patient.id
+    ).filter(PatientNameToken.token == token).order_by(Patient.id).limit(50).all()
+
+    # Queries longer than the indexed prefix length may match extra rows; verify.
+    needle = normalize_name_for_index(query)
+    results = []
+    for patient in candidates:
+        suffixes = name_search_suffixes(normalize_name_for_index(patient.name))
+        if any(suffix.startswith(needle) for suffix in suffixes):
+            results.append({'id': patient.id, 'pid': patient.pid, 'name': patient.name})
+
+    return jsonify({'results': results})
+
+
 @app.route('/patient/<int:patient_id>')
 @login_required
 def view_patient(patient_id):
@@ -364,6 +538,7 @@ def add_appointment():
         new_appt = Appointment(patient_id=patient_id, date=date_obj, description=description)
         db.session.add(new_appt)
         db.session.commit()
+        scheduler_tasks.notify_appointments_changed()
         return redirect(url_for('view_patient', patient_id=patient_id))
     
     return redirect(url_for('index'))
@@ -386,23 +561,16 @@ def send_appointment_reminder_now(appointment_id):
     msg += f"\n\n行事曆連結：{cal_link}"
     
     try:
-        client = BaileysClient()
         # Send initial greeting if not yet greeted
-        send_patient_greeting_if_needed(patient, client)
+        enqueue_greeting_if_needed(patient, commit=False)
         
-        print(f"Sending manual reminder to {patient.name} ({patient.phone_number})...")
-        result = client.send_message(patient.phone_number, msg)
-        
-        if result and result.get('status') == 'sent':
-            appointment.reminded = True
-            db.session.commit()
-            flash('Reminder sent successfully!', 'success')
-        else:
-            error_message = (result or {}).get('error', 'Unknown error')
-            flash(f'Failed to send reminder: {error_message}', 'error')
+        print(f"Queueing manual reminder to {patient.name} ({patient.phone_number})...")
+        enqueue_message(patient.phone_number, msg, 'appointment_reminder', patient=patient, appointment=appointment)
+        flash('Reminder queued; it will be marked sent once delivered.', 'success')
             
     except Exception as e:
-        flash(f'Error sending reminder: {str(e)}', 'error')
+        db.session.rollback()
+        flash(f'Error queueing reminder: {str(e)}', 'error')
 
     return redirect(url_for('view_patient', patient_id=patient.id))
 
@@ -411,6 +579,7 @@ def send_appointment_reminder_now(appointment_id):
 def delete_appointment(appointment_id):
     appointment = Appointment.query.get_or_404(appointment_id)
     patient_id = appointment.patient_id
+    cancel_undelivered('Cancelled: appointment deleted', appointment_id=appointment_id)
     db.session.delete(appointment)
     db.session.commit()
     flash('Appointment cancelled.', 'success')
@@ -422,6 +591,7 @@ def edit_appointment(appointment_id):
     appointment = Appointment.query.get_or_404(appointment_id)
     appointment.description = request.form.get('description', '').strip() or None
     db.session.commit()
+    scheduler_tasks.notify_appointments_changed()
     flash('Appointment updated.', 'success')
     return redirect(url_for('view_patient', patient_id=appointment.patient_id))
 
@@ -498,17 +668,11 @@ def confirm_send_birthday_card(patient_id):
     elif action == 'send':
         card_text = request.form.get('card_text')
         try:
-            client = BaileysClient()
-            result = client.send_message(patient.phone_number, card_text)
-            if result and result.get('status') != 'error':
-                patient.birthday_card_sent_year = now_gmt8().year
-                db.session.commit()
-                flash('Birthday card sent successfully!', 'success')
-            else:
-                error_message = (result or {}).get('error', 'Unknown error')
-                flash(f'Failed to send birthday card: {error_message}', 'error')
+            enqueue_message(patient.phone_number, card_text, 'birthday_card', patient=patient)
+            flash('Birthday card queued; it will be marked sent once delivered.', 'success')
         except Exception as e:
-            flash(f'Error sending birthday card: {str(e)}', 'error')
+            db.session.rollback()
+            flash(f'Error queueing birthday card: {str(e)}', 'error')
         return redirect(url_for('view_patient', patient_id=patient_id))
     
     return redirect(url_for('view_patient', patient_id=patient_id))
@@ -539,24 +703,21 @@ def whatsapp_webhook():
                 matched_patients = [legacy_match]
 
         if len(matched_patients) > 1:
-            client = BaileysClient()
-            client.send_message(sender, "此電話號碼對應多位病人，系統暫時無法自動識別。請聯絡診所職員處理。")
+            enqueue_message(sender, "此電話號碼對應多位病人，系統暫時無法自動識別。請聯絡診所職員處理。", 'reply')
             return jsonify({'status': 'ignored', 'reason': 'ambiguous_phone_match'}), 200
 
         patient = matched_patients[0] if matched_patients else None
         
         if patient:
-            client = BaileysClient()
-            
             # Send initial greeting if not yet greeted
-            send_patient_greeting_if_needed(patient, client)
+            enqueue_greeting_if_needed(patient, commit=False)
 
             # Check length (max 500 characters)
             if len(message_content) > 500:
-                client.send_message(sender, "您輸入的內容超過 500 字，請縮短後再發送。")
+                enqueue_message(sender, "您輸入的內容超過 500 字，請縮短後再發送。", 'reply', patient=patient)
                 return jsonify({'status': 'ignored', 'reason': 'message_too_long'}), 200
             
-            client.send_message(sender, "已收到您的訊息。請留意系統發送的預約、生日卡及問卷通知。")
+            enqueue_message(sender, "已收到您的訊息。請留意系統發送的預約、生日卡及問卷通知。", 'reply', patient=patient)
             return jsonify({'status': 'received'}), 200
         else:
             print(f"Received message from unknown number: {sender}")
@@ -614,6 +775,7 @@ def _migrate_db():
             ("phone_lookup_hash", "ALTER TABLE patient ADD COLUMN phone_lookup_hash VARCHAR(64)"),
             ("send_survey_reminders", "ALTER TABLE patient ADD COLUMN send_survey_reminders BOOLEAN NOT NULL DEFAULT 1"),
             ("last_survey_reminder_date", "ALTER TABLE patient ADD COLUMN last_survey_reminder_date DATE"),
+            ("birth_mmdd", "ALTER TABLE patient ADD COLUMN birth_mmdd INTEGER"),
         ]
         for col, sql in migrations:
             if col not in existing:
@@ -623,6 +785,11 @@ def _migrate_db():
         # Best-effort indexes for PID and phone lookup.
         conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ix_patient_pid ON patient(pid) WHERE pid IS NOT NULL"))
         conn.execute(text("CREATE INDEX IF NOT EXISTS ix_patient_phone_lookup_hash ON patient(phone_lookup_hash)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_patient_birth_mmdd ON patient(birth_mmdd)"))
+        conn.execute(text(
+            "UPDATE patient SET birth_mmdd = CAST(strftime('%m%d', birthdate) AS INTEGER) "
+            "WHERE birthdate IS NOT NULL AND birth_mmdd IS NULL"
+        ))
         conn.commit()
 
     # Ensure new lookup hashes exist for old rows.
@@ -636,10 +803,44 @@ def _migrate_db():
 
     # Ensure the new response-tracking table exists for older databases.
     QualtricsResponse.__table__.create(db.engine, checkfirst=True)
+    PatientNameToken.__table__.create(db.engine, checkfirst=True)
+    SftpFileMetadata.__table__.create(db.engine, checkfirst=True)
+    SftpIngestLedger.__table__.create(db.engine, checkfirst=True)
     SurveyLinkOverride.__table__.create(db.engine, checkfirst=True)
     SurveyReminderEvent.__table__.create(db.engine, checkfirst=True)
     SurveyReminderEscalation.__table__.create(db.engine, checkfirst=True)
     AppSetting.__table__.create(db.engine, checkfirst=True)
+    OutboundMessage.__table__.create(db.engine, checkfirst=True)
+
+    with db.engine.connect() as conn:
+        for table in ('sftp_file_metadata', 'sftp_ingest_ledger'):
+            cols = [row[1] for row in conn.execute(text(f"PRAGMA table_info({table})")).fetchall()]
+            if 'archived_at' not in cols:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN archived_at DATETIME"))
+                print(f"DB migration: added column 'archived_at' to {table} table.")
+        appointment_cols = [row[1] for row in conn.execute(text("PRAGMA table_info(appointment)")).fetchall()]
+        if 'reminder_due_at' not in appointment_cols:
+            conn.execute(text("ALTER TABLE appointment ADD COLUMN reminder_due_at DATETIME"))
+            print("DB migration: added column 'reminder_due_at' to appointment table.")
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_appointment_reminded_due ON appointment(reminded, reminder_due_at)"))
+        outbox_cols = [row[1] for row in conn.execute(text("PRAGMA table_info(outbound_message)")).fetchall()]
+        if 'coalesced_into_id' not in outbox_cols:
+            conn.execute(text("ALTER TABLE outbound_message ADD COLUMN coalesced_into_id INTEGER REFERENCES outbound_message(id)"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_outbound_message_coalesced_into_id ON outbound_message(coalesced_into_id)"))
+            print("DB migration: added column 'coalesced_into_id' to outbound_message table.")
+        # Cancellations used to be stored as dead letters, which a requeue would resend.
+        conn.execute(text(
+            "UPDATE outbound_message SET status = 'cancelled' "
+            "WHERE status = 'dead' AND last_error LIKE 'Cancelled:%'"
+        ))
+        # Earlier patient deletions left the patient's phone and messages behind.
+        conn.execute(text(
+            "UPDATE outbound_message SET phone_encrypted = '', phone_hash = :blank_hash, message = '', "
+            "status = CASE WHEN status = 'sent' THEN status ELSE 'cancelled' END "
+            "WHERE patient_id IS NOT NULL AND patient_id NOT IN (SELECT id FROM patient) "
+            "AND phone_hash != :blank_hash"
+        ), {'blank_hash': hash_data('')})
+        conn.commit()
 
     with db.engine.connect() as conn:
         existing_qr_cols = [row[1] for row in conn.execute(text("PRAGMA table_info(qualtrics_response)")).fetchall()]
@@ -648,19 +849,82 @@ def _migrate_db():
             conn.execute(text("CREATE INDEX IF NOT EXISTS ix_qualtrics_response_survey_code ON qualtrics_response(survey_code)"))
             conn.commit()
 
+    # Backfill reminder due times for appointments created before the column existed.
+    undue = Appointment.query.filter(Appointment.reminder_due_at.is_(None)).all()
+    for appointment in undue:
+        appointment.reminder_due_at = appointment_reminder_due_at(appointment.date)
+    if undue:
+        db.session.commit()
+
+    # Backfill the name blind index for patients created before it existed.
+    indexed_ids = db.session.query(PatientNameToken.patient_id).distinct()
+    unindexed = Patient.query.filter(Patient.id.notin_(indexed_ids)).all()
+    for patient in unindexed:
+        patient.rebuild_name_index()
+    if unindexed:
+        db.session.commit()
+
     # As requested: add mock P01-P10 patients if missing.
     seed_mock_patients()
 
 
+@app.cli.command('rotate-encryption-keys')
+def rotate_encryption_keys_command():
+    """Re-encrypt stored PII under the current ENCRYPTION_KEY."""
+    scheduler_tasks.rotate_encryption_keys(app)
+
+
+@app.cli.command('plan-reminders')
+@click.option('--job', type=click.Choice(['survey', 'appointments']), default='survey', show_default=True)
+@click.option('--summary', is_flag=True, help='Omit the planned message texts.')
+def plan_reminders_command(job, summary):
+    """Dry-run a reminder job and print its plan and timings as JSON."""
+    if job == 'appointments':
+        report = scheduler_tasks.send_appointment_reminders(app, plan_only=True)
+    else:
+        report = scheduler_tasks.send_daily_survey_reminders(app, plan_only=True)
+    if summary:
+        report.pop('messages', None)
+    click.echo(json.dumps(report, ensure_ascii=False, indent=2, default=str))
+
+
+@app.cli.command('rebuild-name-index')
+def rebuild_name_index_command():
+    """Recompute blind-index tokens for every patient (e.g. after changing BLIND_INDEX_KEY)."""
+    last_id = 0
+    rebuilt = 0
+    while True:
+        batch = Patient.query.filter(Patient.id > last_id).order_by(Patient.id).limit(500).all()
+        if not batch:
+            break
+        for patient in batch:
+            patient.rebuild_name_index()
+        db.session.commit()
+        rebuilt += len(batch)
+        last_id = batch[-1].id
+    print(f"Rebuilt name index for {rebuilt} patients.")
+
+
 def create_scheduler():
     scheduler = BackgroundScheduler()
-    # Check for appointments every hour (or once a day)
-    scheduler.add_job(func=scheduler_tasks.send_appointment_reminders, args=[app], trigger="interval", hours=1)
+    # Appointment reminders wake at the earliest reminder_due_at (or when appointments change)
+    scheduler.start()
+    scheduler_tasks.start_appointment_reminder_scheduler(app, scheduler)
+
+    # Daily jobs go through run_when_wa_ready, which defers them while wa-service is down.
+    # Tell staff about today's birthdays (cards are still sent manually)
+    scheduler.add_job(
+        func=scheduler_tasks.run_when_wa_ready,
+        args=[app, scheduler, 'birthday_notices', scheduler_tasks.send_daily_birthday_notices],
+        trigger="cron", hour=8, minute=30,
+    )
 
     # Sync Qualtrics responses and remind non-responders daily at 9:00 AM
-    scheduler.add_job(func=scheduler_tasks.send_daily_survey_reminders, args=[app], trigger="cron", hour=9, minute=0)
-
-    scheduler.start()
+    scheduler.add_job(
+        func=scheduler_tasks.run_when_wa_ready,
+        args=[app, scheduler, 'survey_reminders', scheduler_tasks.send_daily_survey_reminders],
+        trigger="cron", hour=9, minute=0,
+    )
 
 if __name__ == '__main__':
     with app.app_context():
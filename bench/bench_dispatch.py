@@ -0,0 +1,129 @@
+"""
+Benchmark: WhatsApp dispatch against a local fake wa-service that sleeps
+--latency seconds per message. Compares the old one-request-per-message
+loop with iter_dispatch_messages at several concurrency levels and with
+the asyncio dispatcher. The fake sends a batch's phones four at a time and
+each phone's messages in order, like wa-service's /send-batch.
+
+    python bench/bench_dispatch.py [--phones 300] [--latency 0.02]
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from services import AsyncBaileysClient, BaileysClient, aiohttp, aiter_dispatch_messages, iter_dispatch_messages  # noqa: E402
+
+FAKE_SEND_BATCH_CONCURRENCY = 4
+
+
+class FakeWaService(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out as separate writes; without this, delayed ACKs
+    # add ~40 ms to every keep-alive response.
+    disable_nagle_algorithm = True
+    latency = 0.0
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._reply(200, {'ready': True})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if self.path == '/send-message':
+            time.sleep(self.latency)
+            return self._reply(200, {'status': 'sent'})
+        if self.path != '/send-batch':
+            return self._reply(404, {'error': 'not found'})
+
+        by_phone = {}
+        for message in body.get('messages', []):
+            by_phone.setdefault(message['phone'], []).append(message)
+        with ThreadPoolExecutor(max_workers=FAKE_SEND_BATCH_CONCURRENCY) as pool:
+            list(pool.map(lambda messages: time.sleep(self.latency * len(messages)), by_phone.values()))
+        self._reply(200, {'results': [{'status': 'sent'} for _ in body.get('messages', [])]})
+
+
+def start_fake_wa_service(latency):
+    FakeWaService.latency = latency
+    ThreadingHTTPServer.request_queue_size = 256
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeWaService)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+def build_messages(phones):
+    """Every third phone also gets a greeting first, as on a patient's first reminder."""
+    messages = []
+    for i in range(phones):
+        phone = f'8529{i:07d}'
+        if i % 3 == 0:
+            messages.append((phone, 'greeting'))
+        messages.append((phone, 'reminder'))
+    return messages
+
+
+def timed(run):
+    started = time.perf_counter()
+    results = run()
+    elapsed = time.perf_counter() - started
+    assert all(result and result.get('status') == 'sent' for result in results)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--phones', type=int, default=300)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds per message at the fake wa-service')
+    args = parser.parse_args()
+
+    server, base_url = start_fake_wa_service(args.latency)
+    messages = build_messages(args.phones)
+    client = BaileysClient()
+    client.base_url = base_url
+    print(f"{len(messages)} messages to {args.phones} phones, {args.latency * 1000:g} ms per message")
+
+    def one_at_a_time():
+        return [client.send_message(phone, message) for phone, message in messages]
+
+    def threaded(concurrency):
+        return [result for _, result in iter_dispatch_messages(client, messages, concurrency)]
+
+    async def event_loop():
+        async_client = AsyncBaileysClient()
+        # The base URL is read when the session opens in __aenter__.
+        async_client.base_url = base_url
+        async with async_client:
+            return [result async for _, result in aiter_dispatch_messages(async_client, messages)]
+
+    def with_event_loop():
+        return asyncio.run(event_loop())
+
+    print(f"{'one request per message':>28}: {timed(one_at_a_time):6.2f}s")
+    for concurrency in (1, 4, 8):
+        print(f"{f'iter_dispatch concurrency={concurrency}':>28}: {timed(lambda: threaded(concurrency)):6.2f}s")
+    if aiohttp is not None:
+        print(f"{'aiter_dispatch (asyncio)':>28}: {timed(with_event_loop):6.2f}s")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+Micro-benchmark: per-row cost of decrypting a 10k-patient table (three
+encrypted columns per row) with a new Fernet built for every value, as
+EncryptedType used to do, versus the cached process-wide keyring.
+
+    python bench/bench_keyring.py [--patients 10000] [--repeat 5]
+"""
+import argparse
+import os
+import sys
+import timeit
+from pathlib import Path
+
+from cryptography.fernet import Fernet
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('ENCRYPTION_KEY', Fernet.generate_key().decode())
+
+from models import EncryptedString  # noqa: E402
+
+ENCRYPTED_COLUMNS_PER_PATIENT = 3
+
+
+def decrypt_per_value(value):
+    """The old EncryptedType path: read the key and build a Fernet each time."""
+    fernet = Fernet(os.getenv('ENCRYPTION_KEY'))
+    return fernet.decrypt(value.encode('utf-8')).decode('utf-8')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--patients', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    fernet = Fernet(os.environ['ENCRYPTION_KEY'])
+    tokens = [
+        fernet.encrypt(f'Patient {i} column {c}'.encode('utf-8')).decode('utf-8')
+        for i in range(args.patients)
+        for c in range(ENCRYPTED_COLUMNS_PER_PATIENT)
+    ]
+    column_type = EncryptedString(255)
+
+    cases = [
+        ('per-value Fernet', lambda: [decrypt_per_value(v) for v in tokens]),
+        ('cached keyring', lambda: [column_type.process_result_value(v, None) for v in tokens]),
+    ]
+    for name, run in cases:
+        seconds = min(timeit.repeat(run, number=1, repeat=args.repeat))
+        print(f"{name:>18}: {seconds * 1e6 / args.patients:7.1f} us per patient row ({seconds:.3f}s total)")
+
+
+if __name__ == '__main__':
+    main()
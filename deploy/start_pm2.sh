@@ -6,7 +6,7 @@ PROJECT_DIR="/opt/whatsapp-health-bot/whatsapp-health-bot"
 cd "$PROJECT_DIR"
 source .venv/bin/activate
 
-pm2 delete healthbot-web healthbot-scheduler healthbot-wa-service >/dev/null 2>&1 || true
+pm2 delete healthbot-web healthbot-scheduler healthbot-sftp-watcher healthbot-outbox-worker healthbot-wa-service >/dev/null 2>&1 || true
 pm2 start ecosystem.config.cjs --update-env
 pm2 save
 
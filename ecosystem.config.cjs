@@ -26,6 +26,30 @@ module.exports = {
       max_restarts: 10,
       restart_delay: 3000,
     },
+    {
+      name: 'healthbot-sftp-watcher',
+      cwd: '/opt/whatsapp-health-bot/whatsapp-health-bot',
+      script: '/opt/whatsapp-health-bot/whatsapp-health-bot/.venv/bin/python',
+      args: 'sftp_watcher.py',
+      env: {
+        FLASK_ENV: 'production',
+        SESSION_COOKIE_SECURE: '1',
+      },
+      max_restarts: 10,
+      restart_delay: 3000,
+    },
+    {
+      name: 'healthbot-outbox-worker',
+      cwd: '/opt/whatsapp-health-bot/whatsapp-health-bot',
+      script: '/opt/whatsapp-health-bot/whatsapp-health-bot/.venv/bin/python',
+      args: 'outbox_worker.py',
+      env: {
+        FLASK_ENV: 'production',
+        SESSION_COOKIE_SECURE: '1',
+      },
+      max_restarts: 10,
+      restart_delay: 3000,
+    },
     {
       name: 'healthbot-wa-service',
       cwd: '/opt/whatsapp-health-bot/whatsapp-health-bot/wa-service',
@@ -1,10 +1,18 @@
 import os
+import calendar
 import hashlib
+import hmac
+import re
+import threading
+import time
 import uuid
+from collections import OrderedDict
+from datetime import datetime, time as dt_time, timedelta
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.types import TypeDecorator, String, Text
 from sqlalchemy import UniqueConstraint
-from cryptography.fernet import Fernet
+from sqlalchemy.orm import validates
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
 from time_utils import now_gmt8_naive
 
 db = SQLAlchemy()
@@ -19,30 +27,166 @@ def get_encryption_key():
         return None 
     return key
 
+
+def get_previous_encryption_keys():
+    """Retired keys (comma-separated) that may still decrypt existing rows."""
+    raw = os.getenv('ENCRYPTION_PREVIOUS_KEYS', '')
+    return [k.strip() for k in raw.split(',') if k.strip()]
+
+
+# Process-wide keyring, rebuilt only when the configured keys change.
+_keyring_cache = {'source': None, 'keyring': None}
+
+
+class Keyring:
+    """Primary Fernet for encryption plus retired keys accepted for decryption."""
+
+    def __init__(self, primary_key, previous_keys=()):
+        self.primary = Fernet(primary_key)
+        self.previous = [Fernet(k) for k in previous_keys if k != primary_key]
+        self.multi = MultiFernet([self.primary] + self.previous)
+
+    def encrypt(self, data):
+        return self.primary.encrypt(data)
+
+    def decrypt(self, token):
+        # Try the primary key directly; MultiFernet's loop is only needed for
+        # rows still encrypted under a retired key.
+        try:
+            return self.primary.decrypt(token)
+        except InvalidToken:
+            if not self.previous:
+                raise
+        return self.multi.decrypt(token)
+
+    def rotate(self, token):
+        return self.multi.rotate(token)
+
+
+def get_keyring():
+    """
+    Returns the process-wide Keyring built from ENCRYPTION_KEY and
+    ENCRYPTION_PREVIOUS_KEYS, or None when no key is configured.
+    """
+    source = (os.getenv('ENCRYPTION_KEY'), os.getenv('ENCRYPTION_PREVIOUS_KEYS', ''))
+    if _keyring_cache['source'] == source:
+        return _keyring_cache['keyring']
+
+    key = get_encryption_key()
+    _keyring_cache['keyring'] = Keyring(key, get_previous_encryption_keys()) if key else None
+    _keyring_cache['source'] = source
+    return _keyring_cache['keyring']
+
+
+def encrypt_value(value, keyring=None):
+    keyring = keyring or get_keyring()
+    if value is None or keyring is None:
+        return value
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    return keyring.encrypt(value).decode('utf-8')
+
+
+def decrypt_value(value, keyring=None):
+    keyring = keyring or get_keyring()
+    if value is None or keyring is None:
+        return value
+    try:
+        return keyring.decrypt(value.encode('utf-8')).decode('utf-8')
+    except Exception:
+        # In case of decryption failure (e.g. old plain data), return as is
+        return value
+
+
+class DecryptCache:
+    """
+    Bounded in-process LRU of plaintexts keyed by a SHA-256 digest of the
+    ciphertext. Fernet tokens are unique per encryption, so an unchanged
+    ciphertext always maps to the same plaintext.
+    """
+
+    def __init__(self, max_size=0, ttl_seconds=300):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def get(self, digest):
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None and entry[1] > time.monotonic():
+                self._entries.move_to_end(digest)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[digest]
+            self.misses += 1
+            return None
+
+    def put(self, digest, plaintext):
+        with self._lock:
+            self._entries[digest] = (plaintext, time.monotonic() + self.ttl_seconds)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl_seconds': self.ttl_seconds,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+# Opt-in: DECRYPT_CACHE_SIZE=0 (default) disables caching entirely.
+decrypt_cache = DecryptCache(
+    max_size=int(os.getenv('DECRYPT_CACHE_SIZE', '0')),
+    ttl_seconds=int(os.getenv('DECRYPT_CACHE_TTL_SECONDS', '300')),
+)
+
+
+def cached_decrypt_value(value):
+    if value is None or not decrypt_cache.enabled:
+        return decrypt_value(value)
+
+    digest = hashlib.sha256(value.encode('utf-8')).digest()
+    plaintext = decrypt_cache.get(digest)
+    if plaintext is not None:
+        return plaintext
+
+    plaintext = decrypt_value(value)
+    # Failed decryptions return the ciphertext unchanged; don't pin those.
+    if plaintext is not value:
+        decrypt_cache.put(digest, plaintext)
+    return plaintext
+
+
 class EncryptedType(TypeDecorator):
     """Abstract generic EncryptedType"""
     impl = String
     cache_ok = True
 
     def process_bind_param(self, value, dialect):
-        key = get_encryption_key()
-        if value is None or not key:
-            return value
-        f = Fernet(key)
-        if isinstance(value, str):
-            value = value.encode('utf-8')
-        return f.encrypt(value).decode('utf-8')
+        return encrypt_value(value)
 
     def process_result_value(self, value, dialect):
-        key = get_encryption_key()
-        if value is None or not key:
-            return value
-        f = Fernet(key)
-        try:
-            return f.decrypt(value.encode('utf-8')).decode('utf-8')
-        except Exception:
-            # In case of decryption failure (e.g. old plain data), return as is or error
-            return value
+        return cached_decrypt_value(value)
 
 class EncryptedString(EncryptedType):
     impl = String
@@ -60,6 +204,71 @@ def generate_unique_phone_hash(phone_number, pid=None):
     suffix = pid if pid else uuid.uuid4().hex
     return hash_data(f"{phone_number}|{suffix}")
 
+def birth_mmdd(value):
+    return value.month * 100 + value.day if value else None
+
+
+def birthday_mmdds_for(day):
+    """month*100+day values whose birthday falls on `day` (Feb 29 -> Feb 28 in common years)."""
+    mmdds = [birth_mmdd(day)]
+    if day.month == 2 and day.day == 28 and not calendar.isleap(day.year):
+        mmdds.append(229)
+    return mmdds
+
+
+NAME_INDEX_MAX_PREFIX = 16
+
+
+def get_blind_index_key():
+    """HMAC key for name blind-index tokens; derived from ENCRYPTION_KEY if unset."""
+    key = os.getenv('BLIND_INDEX_KEY', '').strip()
+    if key:
+        return key.encode('utf-8')
+    enc_key = get_encryption_key() or ''
+    return hmac.new(enc_key.encode('utf-8'), b'patient-name-blind-index', hashlib.sha256).digest()
+
+
+def normalize_name_for_index(name):
+    return re.sub(r'\s+', ' ', str(name or '')).strip().casefold()
+
+
+def name_index_token(kind, text, key=None):
+    """Keyed hash of a normalized name fragment, like phone_lookup_hash but secret."""
+    message = f"{kind}:{text}".encode('utf-8')
+    return hmac.new(key or get_blind_index_key(), message, hashlib.sha256).hexdigest()
+
+
+def name_index_tokens(name):
+    """Full-name token plus prefix tokens starting at every word boundary."""
+    normalized = normalize_name_for_index(name)
+    if not normalized:
+        return set()
+
+    key = get_blind_index_key()
+    fragments = set()
+    for part in name_search_suffixes(normalized):
+        for length in range(1, min(len(part), NAME_INDEX_MAX_PREFIX) + 1):
+            fragments.add(part[:length])
+
+    tokens = {name_index_token('full', normalized, key)}
+    tokens.update(name_index_token('prefix', fragment, key) for fragment in fragments)
+    return tokens
+
+
+def name_search_suffixes(normalized_name):
+    """'mock patient p01' -> ['mock patient p01', 'patient p01', 'p01']"""
+    words = normalized_name.split(' ')
+    return [' '.join(words[i:]) for i in range(len(words))]
+
+
+def name_search_token(query):
+    """Single token to look up for a search string (longer queries are prefix-truncated)."""
+    normalized = normalize_name_for_index(query)
+    if not normalized:
+        return None
+    return name_index_token('prefix', normalized[:NAME_INDEX_MAX_PREFIX])
+
+
 class Patient(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     pid = db.Column(db.String(20), unique=True, nullable=True)
@@ -74,6 +283,8 @@ class Patient(db.Model):
 
     # Birthday (plain date – no PII beyond what name already reveals)
     birthdate = db.Column(db.Date, nullable=True)
+    # Denormalized month*100+day of birthdate so "born today" is an index lookup
+    birth_mmdd = db.Column(db.Integer, nullable=True, index=True)
 
     # Free-text description used by AI to personalise the birthday card
     description = db.Column(EncryptedText, nullable=True)
@@ -91,6 +302,23 @@ class Patient(db.Model):
     greeted = db.Column(db.Boolean, default=False, nullable=False)
 
     appointments = db.relationship('Appointment', backref='patient', lazy=True)
+    name_tokens = db.relationship('PatientNameToken', cascade='all, delete-orphan', lazy=True)
+
+    @validates('birthdate')
+    def _sync_birth_mmdd(self, key, value):
+        self.birth_mmdd = birth_mmdd(value)
+        return value
+
+    @validates('name')
+    def _refresh_name_index(self, key, value):
+        # Re-saving an unchanged name (e.g. the edit form) keeps existing tokens.
+        if self.id is None or value != self.name:
+            self.rebuild_name_index(value)
+        return value
+
+    def rebuild_name_index(self, name=None):
+        tokens = name_index_tokens(self.name if name is None else name)
+        self.name_tokens = [PatientNameToken(token=t) for t in sorted(tokens)]
 
     @property
     def phone_number(self):
@@ -102,12 +330,43 @@ class Patient(db.Model):
         self.phone_lookup_hash = hash_data(value)
         self.phone_hash = generate_unique_phone_hash(value, self.pid)
 
+class PatientNameToken(db.Model):
+    """Blind index over encrypted Patient.name (keyed-HMAC full-name and prefix tokens)."""
+    id = db.Column(db.Integer, primary_key=True)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False, index=True)
+    token = db.Column(db.String(64), nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_patient_name_token_token', 'token', 'patient_id'),
+    )
+
+
+def appointment_reminder_due_at(appointment_date):
+    """Reminders go out the day before, at APPOINTMENT_REMINDER_TIME (HH:MM, default 09:00)."""
+    if appointment_date is None:
+        return None
+    hour, _, minute = os.getenv('APPOINTMENT_REMINDER_TIME', '09:00').partition(':')
+    day_before = appointment_date.date() - timedelta(days=1)
+    return datetime.combine(day_before, dt_time(int(hour), int(minute or 0)))
+
+
 class Appointment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     date = db.Column(db.DateTime, nullable=False)
     description = db.Column(EncryptedString(500), nullable=True) # Encrypted
     patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
     reminded = db.Column(db.Boolean, default=False)
+    # When the reminder should be queued; kept in sync with date
+    reminder_due_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_appointment_reminded_due', 'reminded', 'reminder_due_at'),
+    )
+
+    @validates('date')
+    def _sync_reminder_due_at(self, key, value):
+        self.reminder_due_at = appointment_reminder_due_at(value)
+        return value
 
 
 class QualtricsResponse(db.Model):
@@ -179,3 +438,98 @@ class AppSetting(db.Model):
     setting_value = db.Column(db.Text, nullable=True)
     updated_at = db.Column(db.DateTime, default=now_gmt8_naive, onupdate=now_gmt8_naive, nullable=False)
 
+
+
+class OutboundMessage(db.Model):
+    """Outbox of WhatsApp messages; outbox_worker.py delivers them with retries."""
+    id = db.Column(db.Integer, primary_key=True)
+    phone_encrypted = db.Column(EncryptedString(255), nullable=False)
+    # Groups a phone's messages without decrypting, so they stay in order
+    phone_hash = db.Column(db.String(64), nullable=False, index=True)
+    message = db.Column(EncryptedText, nullable=False)
+    # greeting, appointment_reminder, survey_reminder, staff_alert, birthday_card, birthday_notice, reply, digest
+    kind = db.Column(db.String(30), nullable=False)
+    # pending -> sending -> sent, or dead once max_attempts is reached;
+    # cancelled when its patient or appointment is deleted
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False)
+    next_attempt_at = db.Column(db.DateTime, default=now_gmt8_naive, nullable=False)
+    locked_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+
+    # Bookkeeping applied once delivery is confirmed
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=True, index=True)
+    appointment_id = db.Column(db.Integer, db.ForeignKey('appointment.id'), nullable=True, index=True)
+    survey_code = db.Column(db.String(200), nullable=True)
+    reminder_count = db.Column(db.Integer, nullable=True)
+    # Set on messages folded into a combined per-phone 'digest'; only the
+    # digest is sent, and its outcome is applied to every member.
+    coalesced_into_id = db.Column(db.Integer, db.ForeignKey('outbound_message.id'), nullable=True, index=True)
+
+    created_at = db.Column(db.DateTime, default=now_gmt8_naive, nullable=False)
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+    coalesced_members = db.relationship(
+        'OutboundMessage',
+        backref=db.backref('coalesced_into', remote_side=[id]),
+        lazy=True,
+    )
+
+    __table_args__ = (
+        db.Index('ix_outbound_message_status_due', 'status', 'next_attempt_at'),
+    )
+
+    @property
+    def phone_number(self):
+        return self.phone_encrypted
+
+    @phone_number.setter
+    def phone_number(self, value):
+        self.phone_encrypted = value
+        self.phone_hash = hash_data(value)
+
+
+class SftpFileMetadata(db.Model):
+    """Parse cache for SFTP survey exports, keyed by path and file fingerprint."""
+    id = db.Column(db.Integer, primary_key=True)
+    path = db.Column(db.String(1024), unique=True, nullable=False, index=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    mtime_ns = db.Column(db.BigInteger, nullable=False)
+    inode = db.Column(db.BigInteger, nullable=False)
+    survey_code = db.Column(db.String(200), nullable=True)
+    heading = db.Column(db.Text, nullable=True)
+    row_count = db.Column(db.Integer, nullable=False, default=0)
+    parsed_at = db.Column(db.DateTime, default=now_gmt8_naive, nullable=False)
+    # Set once the export was compressed into the archive; path then points there
+    archived_at = db.Column(db.DateTime, nullable=True)
+
+    def matches(self, stat_result):
+        return (
+            self.size == stat_result.st_size
+            and self.mtime_ns == stat_result.st_mtime_ns
+            and self.inode == stat_result.st_ino
+        )
+
+
+class SftpIngestLedger(db.Model):
+    """Per-file progress of sync_sftp_responses so unchanged exports are skipped."""
+    id = db.Column(db.Integer, primary_key=True)
+    path = db.Column(db.String(1024), unique=True, nullable=False, index=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    mtime_ns = db.Column(db.BigInteger, nullable=False)
+    inode = db.Column(db.BigInteger, nullable=False)
+    # Sampled hash of the bytes before byte_offset; detects replaced files
+    content_hash = db.Column(db.String(64), nullable=False)
+    byte_offset = db.Column(db.BigInteger, nullable=False, default=0)
+    row_count = db.Column(db.Integer, nullable=False, default=0)
+    survey_code = db.Column(db.String(200), nullable=True)
+    ingested_at = db.Column(db.DateTime, default=now_gmt8_naive, nullable=False)
+    archived_at = db.Column(db.DateTime, nullable=True)
+
+    def matches(self, stat_result):
+        return (
+            self.size == stat_result.st_size
+            and self.mtime_ns == stat_result.st_mtime_ns
+            and self.inode == stat_result.st_ino
+        )
@@ -0,0 +1,516 @@
+"""
+Durable outbox for WhatsApp messages. Web routes and scheduler jobs only
+enqueue; outbox_worker.py delivers due messages in batches, retries
+failures with exponential backoff and dead-letters messages that keep
+failing. Bookkeeping such as Appointment.reminded or SurveyReminderEvent
+is written only once wa-service confirms the send.
+"""
+import os
+import time
+from datetime import timedelta
+
+from sqlalchemy import func
+from sqlalchemy.exc import OperationalError
+
+from models import db, OutboundMessage, Patient, Appointment, SurveyReminderEvent, SurveyReminderEscalation
+from services import BaileysClient, aiter_dispatch_messages, build_patient_greeting, iter_dispatch_messages
+from time_utils import now_gmt8_naive
+
+
+UNDELIVERED_STATUSES = ('pending', 'sending')
+# Terminal like 'dead', but never requeued: the patient or appointment is gone.
+CANCELLED_STATUS = 'cancelled'
+PATIENT_DELETED_REASON = 'Cancelled: patient deleted'
+# wa-service answers these for requests that will not succeed on retry
+PERMANENT_FAILURE_STATUS_CODES = (400, 404)
+NOT_ON_WHATSAPP_ERROR = 'Number not registered on WhatsApp'
+
+
+def _get_int_env(name, default):
+    try:
+        return max(1, int(os.getenv(name, str(default))))
+    except ValueError:
+        return default
+
+
+def get_outbox_batch_size():
+    return _get_int_env('OUTBOX_BATCH_SIZE', 50)
+
+
+def get_outbox_max_attempts():
+    return _get_int_env('OUTBOX_MAX_ATTEMPTS', 8)
+
+
+def _retry_delay(attempts):
+    base = _get_int_env('OUTBOX_RETRY_BASE_SECONDS', 30)
+    ceiling = _get_int_env('OUTBOX_RETRY_MAX_SECONDS', 3600)
+    return timedelta(seconds=min(ceiling, base * 2 ** max(0, attempts - 1)))
+
+
+class UnitOfWork:
+    """
+    Buffers database changes and commits them together, once `batch_size`
+    operations are waiting or `interval_seconds` have passed since the last
+    commit, instead of one commit (and one SQLite write lock) per message.
+
+    Each operation is a callable that applies its change to db.session.
+    Operations are buffered and applied at flush time, under no_autoflush,
+    right before the commit. If applying or committing fails, for example on
+    "database is locked", the session is rolled back and the whole buffer is
+    applied and committed again, so a message that was already sent is
+    never left looking unsent.
+    """
+
+    def __init__(self, batch_size=None, interval_seconds=None, commit_retries=3):
+        self.batch_size = batch_size or _get_int_env('OUTBOX_COMMIT_BATCH_SIZE', 25)
+        if interval_seconds is None:
+            interval_seconds = float(os.getenv('OUTBOX_COMMIT_INTERVAL_SECONDS', '2'))
+        self.interval_seconds = interval_seconds
+        self.commit_retries = commit_retries
+        self.commits = 0
+        self._pending = []
+        self._last_commit = time.monotonic()
+
+    def add(self, operation):
+        self._pending.append(operation)
+        if (
+            len(self._pending) >= self.batch_size
+            or time.monotonic() - self._last_commit >= self.interval_seconds
+        ):
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        for attempt in range(self.commit_retries + 1):
+            try:
+                with db.session.no_autoflush:
+                    for operation in self._pending:
+                        operation()
+                db.session.commit()
+                break
+            except OperationalError as e:
+                db.session.rollback()
+                if attempt == self.commit_retries:
+                    raise
+                print(f"Outbox commit failed ({e}); retrying {len(self._pending)} buffered update(s).")
+                time.sleep(0.5 * (attempt + 1))
+        self.commits += 1
+        self._pending = []
+        self._last_commit = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+        return False
+
+
+def enqueue_message(phone, message, kind, patient=None, appointment=None, survey_code=None, reminder_count=None, commit=True):
+    """Adds a message to the outbox. Pass commit=False to enqueue several in one transaction."""
+    row = OutboundMessage(
+        message=message,
+        kind=kind,
+        status='pending',
+        attempts=0,
+        max_attempts=get_outbox_max_attempts(),
+        next_attempt_at=now_gmt8_naive(),
+        patient_id=patient.id if patient is not None else None,
+        appointment_id=appointment.id if appointment is not None else None,
+        survey_code=survey_code,
+        reminder_count=reminder_count,
+    )
+    row.phone_number = phone
+    db.session.add(row)
+    # Reminder plan mode collects what would be queued, then rolls back.
+    collector = db.session.info.get('queued_messages')
+    if collector is not None:
+        collector.append(row)
+    if commit:
+        db.session.commit()
+    return row
+
+
+def enqueue_digest(phone, message, members, patient=None):
+    """
+    Queues one combined message for `members` (unsent rows to the same phone).
+    Members keep their own kind and bookkeeping fields but are never sent on
+    their own; they are marked sent or dead together with the digest.
+    """
+    digest = enqueue_message(phone, message, 'digest', patient=patient, commit=False)
+    for member in members:
+        member.coalesced_into = digest
+    return digest
+
+
+def undelivered_ids(kind, column='patient_id'):
+    """Distinct `column` values of messages of `kind` still waiting for delivery."""
+    col = getattr(OutboundMessage, column)
+    rows = db.session.query(col).filter(
+        OutboundMessage.kind == kind,
+        OutboundMessage.status.in_(UNDELIVERED_STATUSES),
+        col.isnot(None),
+    ).distinct()
+    return {value for (value,) in rows}
+
+
+def enqueue_greeting_if_needed(patient, pending_greetings=None, commit=True):
+    """
+    Queues the first-time greeting unless the patient was greeted or already
+    has one queued. Scheduler jobs pass a preloaded `pending_greetings` set
+    (see undelivered_ids) so this costs no query per patient.
+    """
+    if patient.greeted:
+        return None
+    if pending_greetings is None:
+        pending_greetings = undelivered_ids('greeting') if patient.id else set()
+    if patient.id in pending_greetings:
+        return None
+    pending_greetings.add(patient.id)
+    print(f"Queueing first-time greeting to {patient.name} ({patient.phone_number})...")
+    return enqueue_message(patient.phone_number, build_patient_greeting(patient), 'greeting', patient=patient, commit=commit)
+
+
+def dead_letter_unregistered(rows, client=None, dry_run=False):
+    """
+    Checks the phones of freshly queued `rows` with one wa-service lookup and
+    dead-letters the messages to numbers that are not on WhatsApp, as the
+    worker would after a 404. Returns those phones. Numbers wa-service could
+    not check are left queued; the worker finds out when it sends.
+    """
+    sendable = [row for row in rows if row.coalesced_into is None and row.status == 'pending']
+    if not sendable:
+        return set()
+    client = client or BaileysClient()
+    registered = client.lookup_numbers(row.phone_number for row in sendable)
+    unregistered = {phone for phone, exists in registered.items() if not exists}
+    if dry_run:
+        return unregistered
+    for row in sendable:
+        if row.phone_number in unregistered:
+            for dead in [row] + row.coalesced_members:
+                dead.status = 'dead'
+                dead.last_error = NOT_ON_WHATSAPP_ERROR
+    return unregistered
+
+
+def cancel_undelivered(reason, patient_id=None, appointment_id=None):
+    """
+    Cancels messages still waiting for delivery to a patient or about an
+    appointment that is being deleted, in the caller's transaction. A digest
+    is cancelled together with all of its members, since its text includes
+    them. Cancelled messages are never requeued. A message the worker is
+    sending right now may still go out.
+    """
+    query = OutboundMessage.query.filter(OutboundMessage.status.in_(UNDELIVERED_STATUSES))
+    if patient_id is not None:
+        query = query.filter(OutboundMessage.patient_id == patient_id)
+    if appointment_id is not None:
+        query = query.filter(OutboundMessage.appointment_id == appointment_id)
+    cancelled = 0
+    for row in query.all():
+        digest = row.coalesced_into or row
+        for message in [digest] + digest.coalesced_members:
+            if message.status in UNDELIVERED_STATUSES:
+                message.status = CANCELLED_STATUS
+                message.last_error = reason
+                cancelled += 1
+    return cancelled
+
+
+def scrub_patient_messages(patient_id):
+    """
+    Blanks the phone number and text of every message to or about a patient
+    being deleted, and of digests that include one, in the caller's
+    transaction. Rows are kept (without PII) so a send that is in flight can
+    still record its outcome. Dead letters among them are cancelled, since
+    they no longer have anything to send.
+    """
+    affected = {}
+    for row in OutboundMessage.query.filter(OutboundMessage.patient_id == patient_id).all():
+        for message in (row, row.coalesced_into):
+            if message is not None:
+                affected[message.id] = message
+    for message in list(affected.values()):
+        if message.kind == 'digest':
+            # Members of a cancelled digest must not be requeued without it.
+            for member in message.coalesced_members:
+                affected.setdefault(member.id, member)
+    for message in affected.values():
+        if message.patient_id == patient_id or message.kind == 'digest':
+            message.phone_number = ''
+            message.message = ''
+        if message.status == 'dead':
+            message.status = CANCELLED_STATUS
+            message.last_error = PATIENT_DELETED_REASON
+    return len(affected)
+
+
+def release_stale_claims(now=None):
+    """Returns messages claimed by a worker that died mid-batch to the queue."""
+    now = now or now_gmt8_naive()
+    timeout = timedelta(seconds=_get_int_env('OUTBOX_LOCK_TIMEOUT_SECONDS', 300))
+    released = OutboundMessage.query.filter(
+        OutboundMessage.status == 'sending',
+        OutboundMessage.locked_at < now - timeout,
+    ).update({'status': 'pending', 'locked_at': None}, synchronize_session=False)
+    if released:
+        db.session.commit()
+        print(f"Outbox: released {released} stale claimed message(s).")
+    return released
+
+
+def _find_due_ids(now, batch_size):
+    # A phone whose earlier message is backing off must wait, so messages
+    # to one handset (greeting, then reminder) never overtake each other.
+    waiting = dict(
+        db.session.query(OutboundMessage.phone_hash, func.min(OutboundMessage.id)).filter(
+            OutboundMessage.status == 'pending',
+            OutboundMessage.next_attempt_at > now,
+            OutboundMessage.coalesced_into_id.is_(None),
+        ).group_by(OutboundMessage.phone_hash).all()
+    )
+    due = OutboundMessage.query.filter(
+        OutboundMessage.status == 'pending',
+        OutboundMessage.next_attempt_at <= now,
+        OutboundMessage.coalesced_into_id.is_(None),
+    ).order_by(OutboundMessage.id).limit(batch_size).all()
+    return [row.id for row in due if row.id < waiting.get(row.phone_hash, row.id + 1)]
+
+
+def _claim_ids(now, ids):
+    if not ids:
+        return []
+    OutboundMessage.query.filter(
+        OutboundMessage.id.in_(ids),
+        OutboundMessage.status == 'pending',
+    ).update({'status': 'sending', 'locked_at': now}, synchronize_session=False)
+    db.session.commit()
+    return OutboundMessage.query.filter(
+        OutboundMessage.id.in_(ids),
+        OutboundMessage.status == 'sending',
+        OutboundMessage.locked_at == now,
+    ).order_by(OutboundMessage.id).all()
+
+
+def _find_one(model, **filters):
+    """
+    First `model` row matching `filters`, including rows added earlier in the
+    same UnitOfWork flush. Operations run under no_autoflush, so those are
+    not in the database yet.
+    """
+    for obj in db.session.new:
+        if isinstance(obj, model) and all(getattr(obj, key) == value for key, value in filters.items()):
+            return obj
+    return model.query.filter_by(**filters).first()
+
+
+def _apply_delivery_bookkeeping(row):
+    if row.kind == 'greeting':
+        patient = db.session.get(Patient, row.patient_id) if row.patient_id else None
+        if patient:
+            patient.greeted = True
+    elif row.kind == 'appointment_reminder':
+        appointment = db.session.get(Appointment, row.appointment_id) if row.appointment_id else None
+        if appointment:
+            appointment.reminded = True
+    elif row.kind == 'birthday_card':
+        patient = db.session.get(Patient, row.patient_id) if row.patient_id else None
+        if patient:
+            patient.birthday_card_sent_year = row.created_at.year
+    elif row.kind in ('survey_reminder', 'staff_alert') and db.session.get(Patient, row.patient_id) is None:
+        # The patient was deleted while the message was in flight.
+        return
+    elif row.kind == 'survey_reminder':
+        sent_date = row.created_at.date()
+        exists = _find_one(
+            SurveyReminderEvent,
+            patient_id=row.patient_id,
+            survey_code=row.survey_code,
+            sent_date=sent_date,
+        )
+        if not exists:
+            db.session.add(SurveyReminderEvent(patient_id=row.patient_id, survey_code=row.survey_code, sent_date=sent_date))
+    elif row.kind == 'staff_alert' and row.survey_code:
+        escalation = _find_one(
+            SurveyReminderEscalation,
+            patient_id=row.patient_id,
+            survey_code=row.survey_code,
+        )
+        if escalation is None:
+            db.session.add(
+                SurveyReminderEscalation(
+                    patient_id=row.patient_id,
+                    survey_code=row.survey_code,
+                    reminder_count=row.reminder_count or 0,
+                    recipients=row.phone_number,
+                )
+            )
+        else:
+            recipients = [r for r in (escalation.recipients or '').split(',') if r]
+            if row.phone_number not in recipients:
+                recipients.append(row.phone_number)
+                escalation.recipients = ','.join(recipients)
+
+
+def _classify_outcome(attempts, max_attempts, result):
+    if result is None:
+        # Not attempted because an earlier message to this phone failed.
+        return 'skipped'
+    if result.get('status') != 'error':
+        return 'sent'
+    if result.get('status_code') in PERMANENT_FAILURE_STATUS_CODES or attempts + 1 >= max_attempts:
+        return 'dead'
+    return 'retrying'
+
+
+def _record_outcome(row_id, outcome, result, finished_at):
+    """Applies one delivery outcome; safe to re-run after a rollback."""
+    row = db.session.get(OutboundMessage, row_id)
+    row.locked_at = None
+    if row.status != 'sending' and outcome != 'sent':
+        # Cancelled while in flight (cancel_undelivered); keep it cancelled.
+        return
+    if outcome == 'skipped':
+        row.status = 'pending'
+        row.next_attempt_at = finished_at + _retry_delay(max(1, row.attempts))
+    elif outcome == 'sent':
+        for sent in [row] + row.coalesced_members:
+            sent.status = 'sent'
+            sent.sent_at = finished_at
+            sent.last_error = None
+            _apply_delivery_bookkeeping(sent)
+    else:
+        row.attempts += 1
+        row.last_error = str(result.get('error') or 'Unknown error')[:1000]
+        if outcome == 'dead':
+            for dead in [row] + row.coalesced_members:
+                dead.status = 'dead'
+                dead.last_error = row.last_error
+        else:
+            row.status = 'pending'
+            row.next_attempt_at = finished_at + _retry_delay(row.attempts)
+
+
+def _find_due_batch(batch_size):
+    now = now_gmt8_naive()
+    release_stale_claims(now)
+    return now, _find_due_ids(now, batch_size or get_outbox_batch_size())
+
+
+def _deferred_summary(ids):
+    return {'claimed': 0, 'sent': 0, 'retrying': 0, 'dead': 0, 'commits': 0, 'deferred': len(ids)}
+
+
+def _claim_batch(now, ids):
+    """Claims `ids`; returns (summary, outbound (phone, message) pairs, claimed row details)."""
+    rows = _claim_ids(now, ids)
+    summary = {'claimed': len(rows), 'sent': 0, 'retrying': 0, 'dead': 0, 'commits': 0, 'deferred': 0}
+    outbound = [(row.phone_number, row.message) for row in rows]
+    # Read before any commit expires the rows.
+    claimed = [(row.id, row.kind, row.attempts, row.max_attempts) for row in rows]
+    return summary, outbound, claimed
+
+
+def _record_result(uow, summary, claimed_row, result):
+    row_id, kind, attempts, max_attempts = claimed_row
+    outcome = _classify_outcome(attempts, max_attempts, result)
+    summary['retrying' if outcome == 'skipped' else outcome] += 1
+    if outcome == 'dead':
+        print(f"Outbox: message {row_id} ({kind}) dead-lettered after {attempts + 1} attempt(s): {result.get('error')}")
+    finished_at = now_gmt8_naive()
+    uow.add(lambda: _record_outcome(row_id, outcome, result, finished_at))
+
+
+def deliver_outbox_batch(client=None, batch_size=None):
+    """
+    Claims up to `batch_size` due messages, sends them through wa-service and
+    records each outcome as it arrives, committing through a UnitOfWork.
+    When messages are due but wa-service is not ready, nothing is claimed
+    (no attempt is used up) and the summary reports them as deferred.
+    Returns counts for the batch.
+    """
+    client = client or BaileysClient()
+    now, ids = _find_due_batch(batch_size)
+    if ids and not client.is_ready():
+        return _deferred_summary(ids)
+    summary, outbound, claimed = _claim_batch(now, ids)
+    if not outbound:
+        return summary
+
+    with UnitOfWork() as uow:
+        for index, result in iter_dispatch_messages(client, outbound, stop_phone_on_error=True):
+            _record_result(uow, summary, claimed[index], result)
+    summary['commits'] = uow.commits
+    return summary
+
+
+async def deliver_outbox_batch_async(client, batch_size=None):
+    """
+    deliver_outbox_batch for an event loop: sends through an
+    AsyncBaileysClient so all of the batch's wa-service calls overlap.
+    Database work still runs on the loop's thread, between sends.
+    """
+    now, ids = _find_due_batch(batch_size)
+    if ids and not await client.is_ready():
+        return _deferred_summary(ids)
+    summary, outbound, claimed = _claim_batch(now, ids)
+    if not outbound:
+        return summary
+
+    with UnitOfWork() as uow:
+        async for index, result in aiter_dispatch_messages(client, outbound, stop_phone_on_error=True):
+            _record_result(uow, summary, claimed[index], result)
+    summary['commits'] = uow.commits
+    return summary
+
+
+def get_outbox_stats():
+    # Counts are of messages actually sent to wa-service, so digest members are left out.
+    counts = dict(
+        db.session.query(OutboundMessage.status, func.count(OutboundMessage.id)).filter(
+            OutboundMessage.coalesced_into_id.is_(None),
+        ).group_by(OutboundMessage.status).all()
+    )
+    oldest_pending = db.session.query(func.min(OutboundMessage.created_at)).filter(
+        OutboundMessage.status.in_(UNDELIVERED_STATUSES),
+    ).scalar()
+    dead = OutboundMessage.query.filter(
+        OutboundMessage.status == 'dead',
+        OutboundMessage.coalesced_into_id.is_(None),
+    ).order_by(OutboundMessage.id.desc()).limit(20).all()
+    return {
+        'counts': {status: counts.get(status, 0) for status in ('pending', 'sending', 'sent', 'dead', CANCELLED_STATUS)},
+        'oldest_pending_created_at': oldest_pending.isoformat() if oldest_pending else None,
+        'recent_dead': [
+            {
+                'id': row.id,
+                'kind': row.kind,
+                'patient_id': row.patient_id,
+                'attempts': row.attempts,
+                'last_error': row.last_error,
+                'created_at': row.created_at.isoformat(),
+            }
+            for row in dead
+        ],
+    }
+
+
+def requeue_dead_messages():
+    """
+    Gives every message the worker dead-lettered a fresh set of attempts.
+    Cancelled messages (deleted patients and appointments) stay cancelled.
+    """
+    requeued = OutboundMessage.query.filter_by(status='dead').update(
+        {
+            'status': 'pending',
+            'attempts': 0,
+            'next_attempt_at': now_gmt8_naive(),
+            'locked_at': None,
+        },
+        synchronize_session=False,
+    )
+    db.session.commit()
+    return requeued
@@ -0,0 +1,96 @@
+"""
+Delivers queued WhatsApp messages from the outbound_message table. Runs as
+its own process so web requests and scheduler jobs never wait on wa-service.
+With OUTBOX_ASYNC_DISPATCH=1 the sends run on an asyncio event loop through
+AsyncBaileysClient instead of a thread pool.
+"""
+import asyncio
+import os
+import time
+
+from app import app
+from models import db
+import outbox
+from services import AsyncBaileysClient
+
+
+# Sleep between polls while the outbox is empty; a full batch polls again at once.
+POLL_SECONDS = float(os.getenv('OUTBOX_POLL_SECONDS', '2'))
+ASYNC_DISPATCH = os.getenv('OUTBOX_ASYNC_DISPATCH', '0') == '1'
+
+
+_deferring = False
+
+
+def _report(summary):
+    global _deferring
+    if summary.get('deferred'):
+        # Logged once per outage; the worker keeps polling /ready meanwhile.
+        if not _deferring:
+            print(f"Outbox: wa-service not ready; {summary['deferred']} due message(s) wait until it is.")
+        _deferring = True
+        return summary
+    if _deferring:
+        print('Outbox: wa-service ready; resuming delivery.')
+        _deferring = False
+    if summary['claimed']:
+        print(
+            f"Outbox batch: claimed={summary['claimed']}, sent={summary['sent']}, "
+            f"retrying={summary['retrying']}, dead={summary['dead']}"
+        )
+    return summary
+
+
+def run_once():
+    with app.app_context():
+        summary = outbox.deliver_outbox_batch()
+        db.session.remove()
+    return _report(summary)
+
+
+async def run_once_async(client):
+    with app.app_context():
+        summary = await outbox.deliver_outbox_batch_async(client)
+        db.session.remove()
+    return _report(summary)
+
+
+def work():
+    print(f"Outbox worker started (batch size {outbox.get_outbox_batch_size()}).")
+    while True:
+        try:
+            summary = run_once()
+        except Exception as e:
+            print(f"Outbox worker batch failed: {e}")
+            summary = {'claimed': 0}
+        if summary['claimed'] < outbox.get_outbox_batch_size():
+            time.sleep(POLL_SECONDS)
+
+
+async def work_async():
+    async with AsyncBaileysClient() as client:
+        print(
+            f"Outbox worker started on an event loop (batch size {outbox.get_outbox_batch_size()}, "
+            f"{client.concurrency} calls in flight)."
+        )
+        while True:
+            try:
+                summary = await run_once_async(client)
+            except Exception as e:
+                print(f"Outbox worker batch failed: {e}")
+                summary = {'claimed': 0}
+            if summary['claimed'] < outbox.get_outbox_batch_size():
+                await asyncio.sleep(POLL_SECONDS)
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        db.create_all()
+
+    try:
+        if ASYNC_DISPATCH:
+            asyncio.run(work_async())
+        else:
+            work()
+    except KeyboardInterrupt:
+        pass
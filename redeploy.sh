@@ -61,7 +61,7 @@ npm ci --omit=dev
 cd "$PROJECT_DIR"
 
 log "Compiling Python files for quick syntax validation"
-python3 -m compileall app.py models.py scheduler_tasks.py services.py time_utils.py wsgi.py scheduler_runner.py
+python3 -m compileall app.py models.py scheduler_tasks.py services.py time_utils.py wsgi.py scheduler_runner.py sftp_watcher.py outbox.py outbox_worker.py
 
 log "Restarting PM2 services with updated environment"
 pm2 startOrRestart ecosystem.config.cjs --update-env
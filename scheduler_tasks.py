@@ -1,37 +1,138 @@
 from datetime import datetime, timedelta
+import codecs
 import csv
+import gzip
+import hashlib
+import itertools
 import json
+import math
 import os
 import re
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
 
-from models import db, Patient, Appointment, QualtricsResponse, SurveyLinkOverride, SurveyReminderEvent, SurveyReminderEscalation, AppSetting
-from services import BaileysClient, generate_google_calendar_link, send_patient_greeting_if_needed
+from cryptography.fernet import InvalidToken
+from sqlalchemy import event, func, or_, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import joinedload
+
+from models import db, hash_data, get_keyring, birthday_mmdds_for, Patient, Appointment, QualtricsResponse, SurveyLinkOverride, SurveyReminderEvent, SurveyReminderEscalation, AppSetting, SftpFileMetadata, SftpIngestLedger, OutboundMessage
+from services import BaileysClient, build_greeting_for_names, build_patient_greeting, generate_google_calendar_link
+from outbox import dead_letter_unregistered, enqueue_digest, enqueue_greeting_if_needed, enqueue_message, undelivered_ids, UNDELIVERED_STATUSES
 from time_utils import today_gmt8, now_gmt8_naive
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler = object
+    Observer = None
+
 
 DEFAULT_SFTP_UPLOAD_DIR = '/home/qualtricssftp/uploads'
 MAX_SURVEY_REMINDERS_PER_PATIENT = 7
+KEY_ROTATION_BATCH_SIZE = 500
+DEFAULT_SYNC_BATCH_SIZE = 500
+DEFAULT_ARCHIVE_MIN_AGE_SECONDS = 3600
+LEDGER_HASH_HEAD_BYTES = 64 * 1024
+LEDGER_HASH_TAIL_BYTES = 4 * 1024
+KEY_ROTATION_CHECKPOINT_KEY = 'key_rotation_checkpoint'
+APPOINTMENT_REMINDER_JOB_ID = 'appointment_reminders'
+
+# job id -> when the job first found wa-service not ready (see _defer_until_wa_ready)
+_wa_deferred_since = {}
+
+# Every EncryptedString/EncryptedText column, by table.
+ENCRYPTED_COLUMNS = (
+    ('patient', ('name', 'phone_encrypted', 'description')),
+    ('appointment', ('description',)),
+    ('outbound_message', ('phone_encrypted', 'message')),
+)
+
+
+def _defer_until_wa_ready(job_id):
+    """
+    True when a scheduled job should run later because wa-service is not
+    connected to WhatsApp. After WA_DEFER_MAX_MINUTES (default 120) of
+    deferring, the job runs anyway and the outbox holds its messages until
+    wa-service is back.
+    """
+    if BaileysClient().is_ready():
+        _wa_deferred_since.pop(job_id, None)
+        return False
+    now = now_gmt8_naive()
+    since = _wa_deferred_since.setdefault(job_id, now)
+    max_minutes = float(os.getenv('WA_DEFER_MAX_MINUTES', '120'))
+    if now - since >= timedelta(minutes=max_minutes):
+        print(f"{job_id}: wa-service still not ready after {max_minutes:g} min; queueing anyway.")
+        _wa_deferred_since.pop(job_id, None)
+        return False
+    return True
+
+
+def _wa_retry_at():
+    return now_gmt8_naive() + timedelta(minutes=float(os.getenv('WA_DEFER_MINUTES', '10')))
+
+
+def run_when_wa_ready(app, scheduler, job_id, job):
+    """
+    Scheduler entry for daily jobs: runs job(app) now, or re-schedules itself
+    WA_DEFER_MINUTES (default 10) later while wa-service is not ready.
+    """
+    if _defer_until_wa_ready(job_id):
+        retry_at = _wa_retry_at()
+        print(f"{job_id}: wa-service not ready; deferred to {retry_at:%H:%M}.")
+        scheduler.add_job(
+            func=run_when_wa_ready,
+            args=[app, scheduler, job_id, job],
+            trigger='date',
+            run_date=retry_at,
+            id=f'{job_id}_deferred',
+            replace_existing=True,
+            misfire_grace_time=None,
+        )
+        return None
+    return job(app)
 
 
-def send_appointment_reminders(app):
-    """Checks for appointments scheduled for tomorrow and sends reminders."""
+def send_appointment_reminders(app, plan_only=False):
+    """
+    Queues reminders for tomorrow's appointments whose reminder_due_at has
+    passed. plan_only=True queues nothing and returns the plan report instead.
+    """
     with app.app_context():
-        tomorrow = today_gmt8() + timedelta(days=1)
-        start_of_day = datetime.combine(tomorrow, datetime.min.time())
-        end_of_day = datetime.combine(tomorrow, datetime.max.time())
+        return _run_reminder_job('appointment_reminders', _queue_appointment_reminders, plan_only)
+
+
+def _queue_appointment_reminders(profile, dry_run=False):
+    with profile.stage('planning'):
+        now = now_gmt8_naive()
+        start_of_tomorrow = datetime.combine(today_gmt8() + timedelta(days=1), datetime.min.time())
 
-        appointments = Appointment.query.filter(
-            Appointment.date >= start_of_day,
-            Appointment.date <= end_of_day,
+        # The message says "tomorrow", so appointments later today are skipped.
+        appointments = Appointment.query.options(joinedload(Appointment.patient)).filter(
             Appointment.reminded == False,
+            Appointment.reminder_due_at <= now,
+            Appointment.date >= start_of_tomorrow,
         ).all()
 
-        client = BaileysClient()
-
+        # Reminders still in the outbox are marked reminded once delivered.
+        queued_appointments = undelivered_ids('appointment_reminder', 'appointment_id')
+        pending_greetings = undelivered_ids('greeting')
         for appointment in appointments:
+            if appointment.id in queued_appointments:
+                continue
             patient = appointment.patient
-            send_patient_greeting_if_needed(patient, client)
+            enqueue_greeting_if_needed(patient, pending_greetings, commit=False)
             msg = f"{patient.name}，提提您：您明天 {appointment.date.strftime('%H:%M')} 預約咗覆診。"
 
             cal_link = generate_google_calendar_link(
@@ -41,10 +142,282 @@ def send_appointment_reminders(app):
             )
             msg += f"\n\n行事曆連結：{cal_link}"
             msg += "\n\nZoom會議連結：placeholder.com" 
-            result = client.send_message(patient.phone_number, msg)
-            if result and result.get('status') == 'sent':
-                appointment.reminded = True
-                db.session.commit()
+            enqueue_message(patient.phone_number, msg, 'appointment_reminder', patient=patient, appointment=appointment, commit=False)
+
+
+def get_next_appointment_reminder_due(now=None):
+    """Earliest future reminder_due_at among unreminded appointments, or None."""
+    now = now or now_gmt8_naive()
+    return db.session.query(func.min(Appointment.reminder_due_at)).filter(
+        Appointment.reminded == False,
+        Appointment.reminder_due_at > now,
+    ).scalar()
+
+
+def _get_appointment_wake_file():
+    default = Path(__file__).resolve().parent / 'instance' / 'appointment_reminders.wake'
+    return Path(os.getenv('APPOINTMENT_REMINDER_WAKE_FILE', default))
+
+
+def notify_appointments_changed():
+    """
+    Called by the web app after appointments are added, edited or removed.
+    Touches the wake file so the scheduler process re-plans right away
+    instead of sleeping until the previously computed due time.
+    """
+    wake_file = _get_appointment_wake_file()
+    try:
+        wake_file.parent.mkdir(parents=True, exist_ok=True)
+        wake_file.touch()
+    except OSError as e:
+        print(f"Could not signal appointment reminder scheduler: {e}")
+
+
+def _arm_appointment_reminders(app, scheduler, run_date=None):
+    scheduler.add_job(
+        func=_run_appointment_reminders,
+        args=[app, scheduler],
+        trigger='date',
+        run_date=run_date,
+        id=APPOINTMENT_REMINDER_JOB_ID,
+        replace_existing=True,
+        misfire_grace_time=None,
+    )
+
+
+def _get_wake_file_mtime(wake_file):
+    try:
+        return wake_file.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _run_appointment_reminders(app, scheduler):
+    """One-shot job: queue what is due, then sleep until the next due reminder."""
+    if _defer_until_wa_ready(APPOINTMENT_REMINDER_JOB_ID):
+        retry_at = _wa_retry_at()
+        print(f"Appointment reminders: wa-service not ready; deferred to {retry_at:%H:%M}.")
+        _arm_appointment_reminders(app, scheduler, retry_at)
+        return
+    wake_file = _get_appointment_wake_file()
+    wake_mtime = _get_wake_file_mtime(wake_file)
+    try:
+        send_appointment_reminders(app)
+    finally:
+        with app.app_context():
+            next_due = get_next_appointment_reminder_due()
+        if _get_wake_file_mtime(wake_file) != wake_mtime:
+            # Appointments changed while this run was in progress.
+            _arm_appointment_reminders(app, scheduler)
+        elif next_due is None:
+            print('Appointment reminders: none scheduled; waiting for new appointments.')
+        else:
+            _arm_appointment_reminders(app, scheduler, next_due)
+            print(f"Appointment reminders: next run at {next_due:%Y-%m-%d %H:%M}.")
+
+
+class _WakeOnTouch(FileSystemEventHandler):
+    def __init__(self, wake_file, on_wake):
+        self._wake_file = str(wake_file)
+        self._on_wake = on_wake
+
+    def on_any_event(self, event):
+        if event.event_type not in ('created', 'modified', 'moved'):
+            return
+        if self._wake_file in (event.src_path, getattr(event, 'dest_path', None)):
+            self._on_wake()
+
+
+def start_appointment_reminder_scheduler(app, scheduler):
+    """
+    Replaces hourly polling: the reminder job runs once now to catch up, then
+    re-arms itself for the earliest reminder_due_at. Touching the wake file
+    (notify_appointments_changed) runs it again immediately. Without watchdog
+    the wake file's mtime is polled every APPOINTMENT_WAKE_POLL_SECONDS.
+    """
+    wake_file = _get_appointment_wake_file()
+    wake_file.parent.mkdir(parents=True, exist_ok=True)
+
+    def wake():
+        _arm_appointment_reminders(app, scheduler)
+
+    _arm_appointment_reminders(app, scheduler)
+
+    if Observer is not None:
+        observer = Observer()
+        observer.daemon = True
+        observer.schedule(_WakeOnTouch(wake_file, wake), str(wake_file.parent), recursive=False)
+        observer.start()
+        return observer
+
+    last_seen = {'mtime_ns': _get_wake_file_mtime(wake_file)}
+
+    def poll_wake_file():
+        mtime_ns = _get_wake_file_mtime(wake_file)
+        if mtime_ns is not None and mtime_ns != last_seen['mtime_ns']:
+            last_seen['mtime_ns'] = mtime_ns
+            wake()
+
+    scheduler.add_job(
+        func=poll_wake_file,
+        trigger='interval',
+        seconds=int(os.getenv('APPOINTMENT_WAKE_POLL_SECONDS', '30')),
+        id='appointment_reminder_wake_poll',
+        replace_existing=True,
+    )
+    return None
+
+
+class _JobProfile:
+    """Wall time and SQL statement count per stage of a reminder job run."""
+
+    def __init__(self):
+        self.timings = {}
+        self.queries = {}
+        self.details = {}
+        self._statements = 0
+
+    def _count_statement(self, *_):
+        self._statements += 1
+
+    def __enter__(self):
+        event.listen(db.engine, 'before_cursor_execute', self._count_statement)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        event.remove(db.engine, 'before_cursor_execute', self._count_statement)
+        return False
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        statements = self._statements
+        try:
+            yield
+        finally:
+            self.timings[name] = round(time.perf_counter() - started, 4)
+            self.queries[name] = self._statements - statements
+
+
+def _estimate_dispatch(messages):
+    """Rough outbox drain time: one phone's messages go serially, phones in parallel."""
+    sends = [row for row in messages if row.coalesced_into is None]
+    per_phone = {}
+    for row in sends:
+        per_phone[row.phone_hash] = per_phone.get(row.phone_hash, 0) + 1
+    concurrency = max(1, int(os.getenv('WA_DISPATCH_CONCURRENCY', '4')))
+    seconds_per_send = float(os.getenv('WA_SEND_ESTIMATE_SECONDS', '1.0'))
+    lanes = max(1, min(concurrency, len(per_phone)))
+    rounds = max([math.ceil(len(sends) / lanes)] + list(per_phone.values())) if sends else 0
+    return {
+        'sends': len(sends),
+        'phones': len(per_phone),
+        'concurrency': concurrency,
+        'seconds_per_send': seconds_per_send,
+        'estimated_seconds': round(rounds * seconds_per_send, 1),
+    }
+
+
+def _describe_planned_messages(messages):
+    positions = {id(row): i for i, row in enumerate(messages)}
+    return [
+        {
+            'kind': row.kind,
+            'phone': row.phone_number,
+            'patient_id': row.patient_id,
+            'appointment_id': row.appointment_id,
+            'survey_code': row.survey_code,
+            'coalesced_into': positions.get(id(row.coalesced_into)) if row.coalesced_into is not None else None,
+            'message': row.message,
+        }
+        for row in messages
+    ]
+
+
+def _run_reminder_job(job, queue_messages, plan_only=False):
+    """
+    Runs a reminder job's queue_messages(profile, dry_run) and commits what it
+    queued. In plan mode nothing is synced, queued or committed; the planned
+    messages, per-stage timings and query counts are returned as a JSON-ready
+    dict instead.
+    """
+    started = time.perf_counter()
+    db.session.info['queued_messages'] = []
+    try:
+        with _JobProfile() as profile, db.session.no_autoflush:
+            queue_messages(profile, dry_run=plan_only)
+            messages = db.session.info['queued_messages']
+            with profile.stage('recipient_lookup'):
+                unregistered = dead_letter_unregistered(messages, dry_run=plan_only)
+        if unregistered and not plan_only:
+            print(f"{job}: dead-lettered messages to {len(unregistered)} recipient(s) not on WhatsApp.")
+        if not plan_only:
+            db.session.commit()
+            return None
+
+        dispatch = _estimate_dispatch(messages)
+        timings = dict(profile.timings, dispatch_estimate=dispatch['estimated_seconds'])
+        by_kind = {}
+        for row in messages:
+            by_kind[row.kind] = by_kind.get(row.kind, 0) + 1
+        report = {
+            'job': job,
+            'generated_at': now_gmt8_naive().isoformat(),
+            'elapsed_seconds': round(time.perf_counter() - started, 4),
+            'timings': timings,
+            'queries': dict(profile.queries, total=sum(profile.queries.values())),
+            'dispatch': dispatch,
+            'messages_by_kind': by_kind,
+            'unregistered_recipients': len(unregistered),
+            'messages': _describe_planned_messages(messages),
+        }
+        report.update(profile.details)
+        db.session.rollback()
+        return report
+    finally:
+        db.session.info.pop('queued_messages', None)
+
+
+def get_pending_birthday_patients(day):
+    """Patients whose birthday is `day` and who have no card recorded this year."""
+    return Patient.query.filter(
+        Patient.birth_mmdd.in_(birthday_mmdds_for(day)),
+        or_(
+            Patient.birthday_card_sent_year.is_(None),
+            Patient.birthday_card_sent_year != day.year,
+        ),
+    ).all()
+
+
+def send_daily_birthday_notices(app):
+    """
+    Daily job: tell staff over WhatsApp whose birthday is today. Cards stay
+    manual, so patients are never messaged from here.
+    """
+    with app.app_context():
+        today = today_gmt8()
+        patients = sorted(get_pending_birthday_patients(today), key=lambda p: p.name or '')
+        if not patients:
+            print('Birthday notice skipped: no pending birthdays today.')
+            return
+
+        staff_numbers = _get_staff_alert_numbers()
+        if not staff_numbers:
+            print(f"Birthday notice pending for {len(patients)} patient(s) but no staff alert numbers are configured.")
+            return
+
+        lines = [f"- {patient.name}（{patient.pid or '未設定 PID'}）" for patient in patients]
+        message = (
+            "[生日卡提示]\n"
+            f"今天有 {len(patients)} 位病人生日：\n"
+            + '\n'.join(lines)
+            + "\n請於系統內預備並發送生日卡。"
+        )
+
+        for phone in staff_numbers:
+            enqueue_message(phone, message, 'birthday_notice', commit=False)
+        db.session.commit()
+        print(f"Birthday notice run complete. birthdays={len(patients)}, staff_queued={len(staff_numbers)}")
 
 
 def _get_sftp_upload_dir():
@@ -71,14 +444,8 @@ def _get_staff_alert_numbers():
     return _normalize_phone_list(os.getenv('STAFF_ALERT_NUMBERS', ''))
 
 
-def _alert_staff_for_stalled_patient(client, patient, survey_code, reminder_count, staff_numbers):
-    if not staff_numbers:
-        print(
-            f"Survey escalation pending for patient_id={patient.id}, survey='{survey_code}' but no staff alert numbers are configured."
-        )
-        return []
-
-    message = (
+def _build_staff_alert_message(patient, survey_code, reminder_count):
+    return (
         "[問卷提醒升級通知]\n"
         f"病人：{patient.name}（{patient.pid or '未設定 PID'}）\n"
         f"問卷：{survey_code}\n"
@@ -87,20 +454,34 @@ def _alert_staff_for_stalled_patient(client, patient, survey_code, reminder_coun
         "請由診所職員跟進。"
     )
 
-    successful_numbers = []
-    for phone in staff_numbers:
-        result = client.send_message(phone, message)
-        if result and result.get('status') != 'error':
-            successful_numbers.append(phone)
 
-    return successful_numbers
+def _alert_staff_for_stalled_patient(item, staff_numbers):
+    patient = item['patient']
+    if not staff_numbers:
+        print(
+            f"Survey escalation pending for patient_id={patient.id}, survey='{item['survey_code']}' but no staff alert numbers are configured."
+        )
+        return 0
+
+    message = _build_staff_alert_message(patient, item['survey_code'], item['reminder_count'])
+    for phone in staff_numbers:
+        enqueue_message(
+            phone,
+            message,
+            'staff_alert',
+            patient=patient,
+            survey_code=item['survey_code'],
+            reminder_count=item['reminder_count'],
+            commit=False,
+        )
+    return 1
 
 
 def _survey_code_from_filename(file_path):
-    stem = Path(file_path).stem
+    stem = Path(_export_name(file_path)).stem
     # Remove common Qualtrics timestamp suffix: _March 15, 2026_18.05
     stem = re.sub(r'_[A-Za-z]+\s+\d{1,2},\s+\d{4}_\d{1,2}\.\d{2}$', '', stem)
-    return stem.strip() or Path(file_path).stem
+    return stem.strip() or Path(_export_name(file_path)).stem
 
 
 def _has_chinese(text):
@@ -137,7 +518,8 @@ def _extract_survey_heading_from_label_rows(rows):
 
     candidates = []
     for row in rows[:3]:
-        for value in row.values():
+        values = row.values() if isinstance(row, dict) else row
+        for value in values:
             if not isinstance(value, str):
                 continue
             v = value.strip()
@@ -162,87 +544,174 @@ def _extract_survey_heading_from_label_rows(rows):
     return _normalize_survey_heading(raw)
 
 
-def _list_sftp_csv_files():
+def _get_sftp_archive_dir():
+    configured = os.getenv('SFTP_ARCHIVE_DIR', '').strip()
+    if configured:
+        return Path(configured).expanduser()
+    return _get_sftp_upload_dir() / 'archive'
+
+
+def _stat_sftp_csv_files(include_archive=False):
+    """
+    (path, stat) pairs for CSV exports, oldest first; one stat() per file.
+    Only unprocessed exports in the upload folder are listed unless
+    include_archive is set, which adds the compressed archive.
+    """
     upload_dir = _get_sftp_upload_dir()
     if not upload_dir.exists() or not upload_dir.is_dir():
         return []
-    return sorted(upload_dir.glob('*.csv'), key=lambda p: p.stat().st_mtime)
+    paths = list(upload_dir.glob('*.csv'))
+    if include_archive:
+        paths += list(_get_sftp_archive_dir().glob('*/*.csv*.gz'))
+    entries = []
+    for path in paths:
+        try:
+            entries.append((path, path.stat()))
+        except FileNotFoundError:
+            continue
+    return sorted(entries, key=lambda entry: entry[1].st_mtime)
 
 
-def _iter_qualtrics_data_rows(file_path):
-    with open(file_path, 'r', encoding='utf-8-sig', newline='') as f:
-        reader = csv.DictReader(f)
-        rows = list(reader)
+def _export_name(file_path):
+    """Original export filename, without the archive's .<mtime_ns>.gz suffix."""
+    name = Path(file_path).name
+    return re.sub(r'(\.\d+(-\d+)?)?\.gz$', '', name)
 
-    heading = _extract_survey_heading_from_label_rows(rows)
 
-    skip = 0
-    for i, row in enumerate(rows[:3]):
-        first_val = next(iter(row.values()), '')
-        if isinstance(first_val, str) and first_val.startswith('{'):
-            skip = i + 1
-            break
+def _open_export_bytes(file_path):
+    if str(file_path).endswith('.gz'):
+        return gzip.open(file_path, 'rb')
+    return open(file_path, 'rb')
 
-    return heading, rows[skip:]
 
+def _list_sftp_csv_files():
+    return [path for path, _ in _stat_sftp_csv_files()]
 
-def _resolve_survey_code(file_path, heading):
-    """Prefer Chinese heading for grouping; fallback to normalized filename."""
-    normalized_heading = _normalize_survey_heading(heading)
-    if normalized_heading:
-        return normalized_heading
-    return _survey_code_from_filename(file_path)
 
+QUALTRICS_METADATA_ROWS = 3
 
-def _extract_pid(row):
-    candidates = (
-        'Q1_6',
-        'QID1_6',
-        'PID',
-        'pid',
-    )
-    pid_raw = None
-    for key in candidates:
-        if key in row and row.get(key):
-            pid_raw = row.get(key)
-            break
-
-    if pid_raw is None:
-        for key, val in row.items():
-            if key and key.lower() in ('q1_6', 'qid1_6', 'pid') and val:
-                pid_raw = val
+
+class _ByteCountingLines:
+    """Yields decoded lines from a binary file while tracking the byte offset consumed."""
+
+    def __init__(self, f):
+        self._f = f
+        self.offset = 0
+        self.at_line_end = True
+
+    def seek(self, offset):
+        self._f.seek(offset)
+        self.offset = offset
+        self.at_line_end = True
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self._f.readline()
+        if not line:
+            raise StopIteration
+        if self.offset == 0 and line.startswith(codecs.BOM_UTF8):
+            text = line[len(codecs.BOM_UTF8):].decode('utf-8')
+        else:
+            text = line.decode('utf-8')
+        self.offset += len(line)
+        # A last line without a newline may still be mid-write.
+        self.at_line_end = line.endswith(b'\n')
+        return text
+
+
+@contextmanager
+def _open_qualtrics_export(file_path, start_offset=0, start_index=0):
+    """
+    Opens a Qualtrics CSV export for streaming. Only the header and the first
+    three metadata rows are buffered (for the survey heading); data rows are
+    read lazily. Yields (heading, records, position) where records is an
+    iterator of (pid, response_id, recorded_at) tuples (pid is None for rows
+    without one) and position.offset is the byte offset just past the last
+    record read. Pass start_offset/start_index to resume after rows that were
+    already ingested.
+    """
+    with _open_export_bytes(file_path) as f:
+        position = _ByteCountingLines(f)
+        raw_reader = csv.reader(position)
+        header = next(raw_reader, [])
+        # Like csv.DictReader, ignore blank lines.
+        reader = (row for row in raw_reader if row)
+        lead_rows = list(itertools.islice(reader, QUALTRICS_METADATA_ROWS))
+
+        heading = _extract_survey_heading_from_label_rows(lead_rows)
+
+        skip = 0
+        for i, row in enumerate(lead_rows):
+            first_val = row[0] if row else ''
+            if first_val.startswith('{'):
+                skip = i + 1
                 break
 
-    if not pid_raw:
-        return None
+        columns = _resolve_export_columns(header)
+        if start_offset:
+            position.seek(start_offset)
+            # Metadata rows may have landed after a header-only first read.
+            data_rows = (row for row in raw_reader if row and not row[0].startswith('{'))
+        else:
+            data_rows = itertools.chain(lead_rows[skip:], reader)
+        records = _iter_export_records(data_rows, columns, _export_name(file_path), start_index)
+        yield heading, records, position
 
-    pid = str(pid_raw).strip().upper()
-    return pid or None
 
+def _resolve_export_columns(header):
+    """Column positions for PID, response id and recorded date, in priority order."""
+    positions = {name: i for i, name in reversed(list(enumerate(header)))}
 
-def _extract_response_id(row, fallback):
-    raw = (
-        row.get('ResponseId')
-        or row.get('responseId')
-        or row.get('_recordId')
-        or row.get('response_id')
-        or fallback
-    )
-    return str(raw).strip()
+    def ordered(candidates, case_insensitive=()):
+        found = [positions[name] for name in candidates if name in positions]
+        found += [i for i, name in enumerate(header) if name and name.lower() in case_insensitive and i not in found]
+        return found
 
+    return {
+        'pid': ordered(('Q1_6', 'QID1_6', 'PID', 'pid'), case_insensitive=('q1_6', 'qid1_6', 'pid')),
+        'response_id': ordered(('ResponseId', 'responseId', '_recordId', 'response_id')),
+        'recorded_at': ordered(('RecordedDate', 'recordedDate', 'EndDate', 'endDate')),
+    }
 
-def _extract_recorded_at(row):
-    for key in ('RecordedDate', 'recordedDate', 'EndDate', 'endDate'):
-        raw = row.get(key)
-        if not raw:
-            continue
-        try:
-            return datetime.fromisoformat(str(raw).replace('Z', '+00:00'))
-        except ValueError:
-            continue
+
+def _first_value(row, positions):
+    for i in positions:
+        if i < len(row) and row[i]:
+            return row[i]
     return None
 
 
+def _iter_export_records(rows, columns, file_name, start_index=0):
+    for i, row in enumerate(rows, start_index):
+        pid_raw = _first_value(row, columns['pid'])
+        pid = str(pid_raw).strip().upper() if pid_raw else None
+
+        response_id = str(_first_value(row, columns['response_id']) or f'{file_name}:{i}').strip()
+
+        recorded_at = None
+        for position in columns['recorded_at']:
+            raw = row[position] if position < len(row) else None
+            if not raw:
+                continue
+            try:
+                recorded_at = datetime.fromisoformat(str(raw).replace('Z', '+00:00'))
+                break
+            except ValueError:
+                continue
+
+        yield pid or None, response_id, recorded_at
+
+
+def _resolve_survey_code(file_path, heading):
+    """Prefer Chinese heading for grouping; fallback to normalized filename."""
+    normalized_heading = _normalize_survey_heading(heading)
+    if normalized_heading:
+        return normalized_heading
+    return _survey_code_from_filename(file_path)
+
+
 def _get_survey_link_config():
     default_link = os.getenv('QUALTRICS_SURVEY_LINK', '').strip()
     raw_map = os.getenv('SURVEY_LINK_MAP_JSON', '').strip()
@@ -256,25 +725,143 @@ def _get_survey_link_config():
         except json.JSONDecodeError:
             print('SURVEY_LINK_MAP_JSON is invalid JSON. Falling back to default survey link.')
 
-    # Per-survey overrides from dashboard (highest priority)
-    for override in SurveyLinkOverride.query.all():
-        key = (override.survey_code or '').strip()
-        val = (override.survey_link or '').strip()
+    # Per-survey overrides from dashboard (highest priority), in one read.
+    overrides = db.session.query(SurveyLinkOverride.survey_code, SurveyLinkOverride.survey_link).all()
+    for survey_code, survey_link in overrides:
+        key = (survey_code or '').strip()
+        val = (survey_link or '').strip()
         if key and val:
             link_map[key] = val
 
     return link_map, default_link
 
 
-def get_sftp_survey_overview():
+def _get_parse_workers(workers=None):
+    if workers is None:
+        workers = int(os.getenv('SFTP_PARSE_WORKERS', '1'))
+    return max(1, workers)
+
+
+def _map_export_files(func, args_list, workers=None):
+    """
+    Applies a module-level parse function to each file's args, in order. With
+    more than one worker the files are parsed in a process pool; results are
+    still returned in input order, so callers behave identically whatever
+    the worker count.
+    """
+    workers = _get_parse_workers(workers)
+    if workers == 1 or len(args_list) < 2:
+        return [func(*args) for args in args_list]
+    with ProcessPoolExecutor(max_workers=min(workers, len(args_list))) as pool:
+        return list(pool.map(func, *zip(*args_list)))
+
+
+def _scan_export_file(file_path):
+    """Worker: (heading, survey_code, row_count) for one export."""
+    with _open_qualtrics_export(file_path) as (heading, records, _):
+        row_count = sum(1 for _ in records)
+    return heading, _resolve_survey_code(file_path, heading), row_count
+
+
+def _iter_parsed_export(file_path, start_offset, start_index, summary, settled=False):
+    """
+    Streams (survey_code, pid, response_id, recorded_at) tuples for rows with
+    a PID. summary is filled with survey_code up front and skipped,
+    byte_offset and row_count (progress up to the last complete record) once
+    the file is exhausted. settled=True means the file is past
+    SFTP_ARCHIVE_MIN_AGE_SECONDS, so a final record without a trailing
+    newline counts as complete too.
+    """
+    with _open_qualtrics_export(file_path, start_offset, start_index) as (heading, records, position):
+        survey_code = _resolve_survey_code(file_path, heading)
+        summary.update(survey_code=survey_code, skipped=0, byte_offset=start_offset, row_count=start_index)
+        rows_read = start_index
+
+        for pid, response_id_raw, recorded_at in records:
+            rows_read += 1
+            if position.at_line_end:
+                summary['byte_offset'], summary['row_count'] = position.offset, rows_read
+            if not pid:
+                summary['skipped'] += 1
+                continue
+            yield survey_code, pid, f'{survey_code}:{response_id_raw}', recorded_at
+
+        if settled:
+            summary['byte_offset'], summary['row_count'] = position.offset, rows_read
+
+
+def _parse_export_file(file_path, start_offset=0, start_index=0, settled=False):
+    """Worker: (summary, rows) for one export, with rows as compact tuples."""
+    summary = {}
+    rows = list(_iter_parsed_export(file_path, start_offset, start_index, summary, settled))
+    return summary, rows
+
+
+def _get_sftp_file_metadata(entries, workers=None):
+    """
+    Returns SftpFileMetadata per path, re-parsing only files whose
+    (size, mtime_ns, inode) fingerprint changed since they were cached.
+    """
+    cached = {row.path: row for row in SftpFileMetadata.query.filter(SftpFileMetadata.archived_at.is_(None))}
+    result = {}
+    stale_entries = []
+
+    for file_path, stat_result in entries:
+        key = str(file_path)
+        meta = cached.pop(key, None)
+        if meta is not None and meta.matches(stat_result):
+            result[key] = meta
+            continue
+        stale_entries.append((file_path, stat_result, meta))
+
+    scans = _map_export_files(_scan_export_file, [(str(entry[0]),) for entry in stale_entries], workers)
+    for (file_path, stat_result, meta), (heading, survey_code, row_count) in zip(stale_entries, scans):
+        key = str(file_path)
+        if meta is None:
+            meta = SftpFileMetadata(path=key)
+            db.session.add(meta)
+        meta.size = stat_result.st_size
+        meta.mtime_ns = stat_result.st_mtime_ns
+        meta.inode = stat_result.st_ino
+        meta.heading = heading
+        meta.survey_code = survey_code
+        meta.row_count = row_count
+        meta.parsed_at = now_gmt8_naive()
+        result[key] = meta
+    changed = bool(stale_entries)
+
+    # Forget files that were removed from the upload folder.
+    for stale in cached.values():
+        db.session.delete(stale)
+        changed = True
+
+    if changed:
+        db.session.commit()
+    return result
+
+
+def _get_response_counts_by_survey():
+    """Response counts for every survey code from a single GROUP BY query."""
+    rows = db.session.query(
+        QualtricsResponse.survey_code,
+        func.count(QualtricsResponse.id),
+    ).group_by(QualtricsResponse.survey_code).all()
+    return {survey_code: count for survey_code, count in rows}
+
+
+def get_sftp_survey_overview(workers=None):
     """Build dashboard survey summary directly from SFTP CSV exports."""
-    files = _list_sftp_csv_files()
+    entries = _stat_sftp_csv_files()
+    metadata = _get_sftp_file_metadata(entries, workers)
+    # Archived exports are summarised from their cached metadata, never re-read.
+    files = list(metadata.values())
+    files += SftpFileMetadata.query.filter(SftpFileMetadata.archived_at.isnot(None)).all()
+    files.sort(key=lambda meta: meta.mtime_ns)
     grouped = {}
 
-    for file_path in files:
-        file_key = _survey_code_from_filename(file_path)
-        heading, _ = _iter_qualtrics_data_rows(file_path)
-        code = _resolve_survey_code(file_path, heading)
+    for meta in files:
+        file_key = _survey_code_from_filename(meta.path)
+        code = meta.survey_code
         grouped.setdefault(code, {
             'survey_code': code,
             'file_count': 0,
@@ -282,13 +869,14 @@ def get_sftp_survey_overview():
             'source_file_key': file_key,
         })
         grouped[code]['file_count'] += 1
-        grouped[code]['latest_file'] = file_path.name
+        grouped[code]['latest_file'] = _export_name(meta.path)
 
     link_map, default_link = _get_survey_link_config()
+    response_counts = _get_response_counts_by_survey()
 
     overview = []
     for code in sorted(grouped.keys()):
-        response_count = QualtricsResponse.query.filter_by(survey_code=code).count()
+        response_count = response_counts.get(code, 0)
         overview.append({
             'survey_code': code,
             'source_file_key': grouped[code]['source_file_key'],
@@ -301,71 +889,519 @@ def get_sftp_survey_overview():
     return overview
 
 
-def sync_sftp_responses():
-    """Ingest all CSV files from the SFTP upload folder into QualtricsResponse."""
-    files = _list_sftp_csv_files()
+def _sampled_content_hash(file_path, end_offset):
+    """
+    SHA-256 over the first 64 KiB and the last 4 KiB before end_offset. Enough
+    to tell an appended export from a replaced one without rereading it all.
+    """
+    digest = hashlib.sha256()
+    with _open_export_bytes(file_path) as f:
+        digest.update(f.read(min(end_offset, LEDGER_HASH_HEAD_BYTES)))
+        tail_start = max(end_offset - LEDGER_HASH_TAIL_BYTES, LEDGER_HASH_HEAD_BYTES)
+        if tail_start < end_offset:
+            f.seek(tail_start)
+            digest.update(f.read(end_offset - tail_start))
+    digest.update(str(end_offset).encode('ascii'))
+    return digest.hexdigest()
+
+
+def _ledger_resume_point(ledger, file_path, stat_result):
+    """
+    Returns (byte_offset, row_index) to continue ingestion from, or None when
+    the file is unchanged. Appended files resume at their ledger offset;
+    replaced or truncated files start over.
+    """
+    if ledger is None:
+        return 0, 0
+    if ledger.matches(stat_result):
+        return None
+    if (
+        ledger.inode == stat_result.st_ino
+        and stat_result.st_size >= ledger.byte_offset
+        and _sampled_content_hash(file_path, ledger.byte_offset) == ledger.content_hash
+    ):
+        return ledger.byte_offset, ledger.row_count
+    return 0, 0
+
+
+def _upsert_qualtrics_responses(rows):
+    """INSERT ... ON CONFLICT(qualtrics_response_id) DO UPDATE for one chunk, in one transaction."""
+    stmt = sqlite_insert(QualtricsResponse.__table__)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['qualtrics_response_id'],
+        set_={
+            'survey_code': stmt.excluded.survey_code,
+            'pid': stmt.excluded.pid,
+            'recorded_at': func.coalesce(stmt.excluded.recorded_at, QualtricsResponse.__table__.c.recorded_at),
+            'last_seen_at': stmt.excluded.last_seen_at,
+        },
+    )
+    db.session.execute(stmt, rows)
+    db.session.commit()
+    return len(rows)
+
+
+def _ingest_parsed_rows(rows, now, batch_size):
     synced = 0
-    skipped = 0
-    survey_codes = set()
-    now = now_gmt8_naive()
+    batch = []
+    for survey_code, pid, response_id, recorded_at in rows:
+        batch.append({
+            'survey_code': survey_code,
+            'pid': pid,
+            'qualtrics_response_id': response_id,
+            'recorded_at': recorded_at,
+            'last_seen_at': now,
+        })
+        if len(batch) >= batch_size:
+            synced += _upsert_qualtrics_responses(batch)
+            batch = []
+    if batch:
+        synced += _upsert_qualtrics_responses(batch)
+    return synced
 
-    for file_path in files:
-        heading, rows = _iter_qualtrics_data_rows(file_path)
-        survey_code = _resolve_survey_code(file_path, heading)
-        survey_codes.add(survey_code)
 
-        for i, row in enumerate(rows):
-            pid = _extract_pid(row)
-            if not pid:
-                skipped += 1
+def _iter_serial_parses(pending, cutoff_ns):
+    """Single-process mode: stream each file instead of materializing its rows."""
+    for file_path, stat_result, _, (start_offset, start_index) in pending:
+        summary = {}
+        settled = stat_result.st_mtime_ns <= cutoff_ns
+        yield summary, _iter_parsed_export(str(file_path), start_offset, start_index, summary, settled)
+
+
+def _archive_cutoff_ns():
+    """Exports last modified before this (ns since the epoch) are no longer being written."""
+    min_age = int(os.getenv('SFTP_ARCHIVE_MIN_AGE_SECONDS', DEFAULT_ARCHIVE_MIN_AGE_SECONDS))
+    return time.time_ns() - min_age * 1_000_000_000
+
+
+def _archive_destination(target_dir, source, stat_result):
+    """
+    <name>.<mtime_ns>.gz in target_dir, so same-named exports archived on the
+    same day never collide; a -<n> counter breaks any remaining tie.
+    """
+    base = f'{source.name}.{stat_result.st_mtime_ns}'
+    destination = target_dir / f'{base}.gz'
+    counter = 1
+    while destination.exists():
+        destination = target_dir / f'{base}-{counter}.gz'
+        counter += 1
+    return destination
+
+
+def _archive_ingested_exports():
+    """
+    Moves fully ingested exports out of the upload folder into
+    <archive>/<YYYY-MM-DD>/<name>.csv.<mtime_ns>.gz, so the hot folder only holds
+    unprocessed files. Exports modified within SFTP_ARCHIVE_MIN_AGE_SECONDS
+    are left alone in case Qualtrics is still appending to them.
+    """
+    upload_dir = _get_sftp_upload_dir()
+    target_dir = _get_sftp_archive_dir() / today_gmt8().isoformat()
+    cutoff_ns = _archive_cutoff_ns()
+    archived = 0
+
+    ledgers = SftpIngestLedger.query.filter(SftpIngestLedger.archived_at.is_(None)).all()
+    metadata = {
+        row.path: row
+        for row in SftpFileMetadata.query.filter(SftpFileMetadata.archived_at.is_(None))
+    }
+
+    for ledger in ledgers:
+        source = Path(ledger.path)
+        if source.parent != upload_dir:
+            continue
+        try:
+            stat_result = source.stat()
+        except FileNotFoundError:
+            continue
+        if not ledger.matches(stat_result) or ledger.byte_offset != stat_result.st_size:
+            continue
+        if stat_result.st_mtime_ns > cutoff_ns:
+            continue
+
+        try:
+            target_dir.mkdir(parents=True, exist_ok=True)
+            destination = _archive_destination(target_dir, source, stat_result)
+            partial = destination.with_name(destination.name + '.part')
+            with open(source, 'rb') as src, gzip.open(partial, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            # link() refuses to replace an archive that appeared meanwhile.
+            os.link(partial, destination)
+            partial.unlink()
+        except OSError as e:
+            print(f"Could not archive {source.name}: {e}")
+            continue
+
+        now = now_gmt8_naive()
+        meta = metadata.get(ledger.path)
+        if meta is None:
+            meta = SftpFileMetadata(
+                size=stat_result.st_size,
+                mtime_ns=stat_result.st_mtime_ns,
+                inode=stat_result.st_ino,
+                survey_code=ledger.survey_code,
+                row_count=ledger.row_count,
+            )
+            db.session.add(meta)
+        meta.path = str(destination)
+        meta.archived_at = now
+        ledger.path = str(destination)
+        ledger.archived_at = now
+        # Record the move before deleting the original: a crash in between
+        # only leaves a duplicate that is re-ingested idempotently.
+        db.session.commit()
+        source.unlink(missing_ok=True)
+        archived += 1
+
+    return archived
+
+
+def _get_sftp_sync_lock_file():
+    default = Path(__file__).resolve().parent / 'instance' / 'sftp_sync.lock'
+    return Path(os.getenv('SFTP_SYNC_LOCK_FILE', default))
+
+
+@contextmanager
+def _sftp_sync_lock():
+    """
+    Exclusive file lock (flock, or msvcrt.locking on Windows) held for a
+    whole sync, so the scheduler and the SFTP watcher never ingest or
+    archive the same export at the same time.
+    """
+    lock_file = _get_sftp_sync_lock_file()
+    lock_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_file, 'a+') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            return
+
+        # msvcrt locks a byte range from the current position; LK_LOCK gives
+        # up after ~10 seconds, so keep waiting like flock does.
+        f.seek(0)
+        while True:
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                break
+            except OSError:
                 continue
+        try:
+            yield
+        finally:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
 
-            response_id_raw = _extract_response_id(row, fallback=f'{file_path.name}:{i}')
-            response_id = f'{survey_code}:{response_id_raw}'
-            recorded_at = _extract_recorded_at(row)
-
-            existing = QualtricsResponse.query.filter_by(qualtrics_response_id=response_id).first()
-            if existing:
-                existing.survey_code = survey_code
-                existing.pid = pid
-                existing.recorded_at = recorded_at or existing.recorded_at
-                existing.last_seen_at = now
-            else:
-                db.session.add(
-                    QualtricsResponse(
-                        survey_code=survey_code,
-                        pid=pid,
-                        qualtrics_response_id=response_id,
-                        recorded_at=recorded_at,
-                        last_seen_at=now,
-                    )
-                )
-            synced += 1
 
-    if synced:
+def sync_sftp_responses(full_rescan=False, batch_size=None, workers=None, dry_run=False, paths=None):
+    """
+    Ingest CSV files from the SFTP upload folder into QualtricsResponse.
+    A per-file ledger skips unchanged exports and resumes appended ones from
+    their last ingested byte offset; full_rescan=True ignores the ledger.
+    Responses are upserted in chunks of batch_size (SFTP_SYNC_BATCH_SIZE).
+    With workers > 1 (SFTP_PARSE_WORKERS) changed files are parsed in a
+    process pool while this process does all DB writes, in file order.
+    dry_run=True parses the same files but writes nothing (no upserts, ledger
+    updates or archiving); the PIDs it would have ingested are returned as
+    pending_responses. paths limits ingestion to those upload files (the
+    watcher passes only exports that have stopped changing). Runs under
+    _sftp_sync_lock, so concurrent callers wait their turn.
+    """
+    with _sftp_sync_lock():
+        return _sync_sftp_responses(full_rescan, batch_size, workers, dry_run, paths)
+
+
+def _sync_sftp_responses(full_rescan, batch_size, workers, dry_run, paths):
+    batch_size = batch_size or int(os.getenv('SFTP_SYNC_BATCH_SIZE', DEFAULT_SYNC_BATCH_SIZE))
+    workers = _get_parse_workers(workers)
+    started = time.perf_counter()
+    entries = _stat_sftp_csv_files(include_archive=full_rescan)
+    if paths is not None:
+        wanted = {str(path) for path in paths}
+        entries = [entry for entry in entries if str(entry[0]) in wanted]
+    ledgers = {row.path: row for row in SftpIngestLedger.query.all()}
+    synced = 0
+    skipped = 0
+    files_unchanged = 0
+    survey_codes = set()
+    pending_responses = {}
+    now = now_gmt8_naive()
+    cutoff_ns = _archive_cutoff_ns()
+
+    pending = []
+    for file_path, stat_result in entries:
+        ledger = ledgers.get(str(file_path))
+        resume = (0, 0) if full_rescan else _ledger_resume_point(ledger, file_path, stat_result)
+        if (
+            resume is None
+            and ledger.byte_offset < stat_result.st_size
+            and stat_result.st_mtime_ns <= cutoff_ns
+        ):
+            # The unterminated last record has settled; pick it up now.
+            resume = ledger.byte_offset, ledger.row_count
+        if resume is None:
+            files_unchanged += 1
+            if ledger.survey_code:
+                survey_codes.add(ledger.survey_code)
+            continue
+        pending.append((file_path, stat_result, ledger, resume))
+    scan_seconds = time.perf_counter() - started
+
+    if workers > 1 and len(pending) > 1:
+        parsed = _map_export_files(
+            _parse_export_file,
+            [
+                (str(file_path), *resume, stat_result.st_mtime_ns <= cutoff_ns)
+                for file_path, stat_result, _, resume in pending
+            ],
+            workers,
+        )
+    else:
+        parsed = _iter_serial_parses(pending, cutoff_ns)
+
+    for (file_path, stat_result, ledger, _), (summary, rows) in zip(pending, parsed):
+        if dry_run:
+            for survey_code, pid, _, _ in rows:
+                pending_responses.setdefault(survey_code, set()).add(pid)
+                synced += 1
+            skipped += summary['skipped']
+            survey_codes.add(summary['survey_code'])
+            continue
+
+        synced += _ingest_parsed_rows(rows, now, batch_size)
+        skipped += summary['skipped']
+        survey_codes.add(summary['survey_code'])
+
+        if ledger is None:
+            ledger = SftpIngestLedger(path=str(file_path))
+            db.session.add(ledger)
+        ledger.size = stat_result.st_size
+        ledger.mtime_ns = stat_result.st_mtime_ns
+        ledger.inode = stat_result.st_ino
+        ledger.byte_offset = summary['byte_offset']
+        ledger.row_count = summary['row_count']
+        ledger.content_hash = _sampled_content_hash(file_path, summary['byte_offset'])
+        ledger.survey_code = summary['survey_code']
+        ledger.ingested_at = now
+        # Ledger progress is committed only after all of the file's chunks, so
+        # a crash mid-file re-reads it; the upsert makes that idempotent.
         db.session.commit()
 
-    return {
+    archive_enabled = not dry_run and os.getenv('SFTP_ARCHIVE_PROCESSED', '1') == '1'
+    archived = _archive_ingested_exports() if archive_enabled else 0
+
+    # Surveys whose exports were all archived still need reminders.
+    archived_codes = db.session.query(SftpIngestLedger.survey_code).filter(
+        SftpIngestLedger.archived_at.isnot(None),
+    ).distinct().all()
+    survey_codes.update(code for (code,) in archived_codes if code)
+
+    elapsed = time.perf_counter() - started
+    result = {
         'synced': synced,
+        'elapsed_seconds': round(elapsed, 3),
+        'scan_seconds': round(scan_seconds, 3),
+        'rows_per_sec': round(synced / elapsed, 1) if elapsed > 0 else None,
         'skipped': skipped,
+        'files_ingested': len(pending),
+        'files_unchanged': files_unchanged,
+        'files_archived': archived,
         'survey_codes': sorted(survey_codes),
     }
+    if dry_run:
+        result['pending_responses'] = pending_responses
+    return result
+
+
+def _load_survey_reminder_state(survey_codes, today):
+    """
+    Preloads everything the reminder planner needs with a fixed number of
+    grouped queries, independent of how many patients and surveys exist.
+    """
+    responded = {}
+    for survey_code, pid in db.session.query(
+        QualtricsResponse.survey_code,
+        QualtricsResponse.pid,
+    ).filter(QualtricsResponse.survey_code.in_(survey_codes)).distinct():
+        if pid:
+            responded.setdefault(survey_code, set()).add(pid.strip().upper())
+
+    sent_today = set(
+        db.session.query(SurveyReminderEvent.patient_id, SurveyReminderEvent.survey_code).filter(
+            SurveyReminderEvent.sent_date == today,
+            SurveyReminderEvent.survey_code.in_(survey_codes),
+        ).all()
+    )
+
+    reminder_counts = {
+        (patient_id, survey_code): count
+        for patient_id, survey_code, count in db.session.query(
+            SurveyReminderEvent.patient_id,
+            SurveyReminderEvent.survey_code,
+            func.count(SurveyReminderEvent.id),
+        ).filter(
+            SurveyReminderEvent.survey_code.in_(survey_codes),
+        ).group_by(SurveyReminderEvent.patient_id, SurveyReminderEvent.survey_code)
+    }
+
+    escalated = set(
+        db.session.query(SurveyReminderEscalation.patient_id, SurveyReminderEscalation.survey_code).filter(
+            SurveyReminderEscalation.survey_code.in_(survey_codes),
+        ).all()
+    )
+
+    # Messages still in the outbox count as sent so a rerun does not queue them twice.
+    for patient_id, survey_code, kind in db.session.query(
+        OutboundMessage.patient_id,
+        OutboundMessage.survey_code,
+        OutboundMessage.kind,
+    ).filter(
+        OutboundMessage.kind.in_(('survey_reminder', 'staff_alert')),
+        OutboundMessage.status.in_(UNDELIVERED_STATUSES),
+        OutboundMessage.survey_code.in_(survey_codes),
+    ).distinct():
+        key = (patient_id, survey_code)
+        if kind == 'staff_alert':
+            escalated.add(key)
+        elif key not in sent_today:
+            sent_today.add(key)
+            reminder_counts[key] = reminder_counts.get(key, 0) + 1
+
+    return {
+        'responded': responded,
+        'sent_today': sent_today,
+        'reminder_counts': reminder_counts,
+        'escalated': escalated,
+    }
+
+
+def _plan_survey_reminders(survey_codes, patients, state, link_map, default_link):
+    """
+    Computes the full send/escalate plan in one pass over preloaded state,
+    before any message goes out. Returns an ordered list of actions.
+    """
+    plan = []
+    for survey_code in survey_codes:
+        responded_pids = state['responded'].get(survey_code, set())
+        survey_link = link_map.get(survey_code) or default_link
+
+        for patient in patients:
+            normalized_pid = patient.pid.strip().upper() if patient.pid else None
+            if not normalized_pid or normalized_pid in responded_pids:
+                continue
 
+            key = (patient.id, survey_code)
+            if key in state['sent_today']:
+                continue
+
+            total_previous = state['reminder_counts'].get(key, 0)
+            if total_previous >= MAX_SURVEY_REMINDERS_PER_PATIENT:
+                if key not in state['escalated']:
+                    plan.append({
+                        'action': 'escalate',
+                        'patient': patient,
+                        'survey_code': survey_code,
+                        'reminder_count': total_previous,
+                    })
+                continue
 
-def send_daily_survey_reminders(app):
+            plan.append({
+                'action': 'remind',
+                'patient': patient,
+                'survey_code': survey_code,
+                'survey_link': survey_link,
+                'reminder_count': total_previous,
+            })
+    return plan
+
+
+def _build_survey_reminder_message(item):
+    message = f"{item['patient'].name}，請填寫以下問卷。\n"
+    if item['survey_link']:
+        message += f"\n問卷連結：{item['survey_link']}"
+    return message
+
+
+def _build_survey_digest_message(items, greet_patients):
+    parts = []
+    if greet_patients:
+        parts.append(build_greeting_for_names([patient.name for patient in greet_patients]))
+    lines = ["請為以下病人填寫問卷："]
+    for item in items:
+        lines.append(f"\n- {item['patient'].name}（{item['survey_code']}）")
+        if item['survey_link']:
+            lines.append(f"  問卷連結：{item['survey_link']}")
+    parts.append('\n'.join(lines))
+    return '\n\n'.join(parts)
+
+
+def _queue_survey_reminders_for_phone(items, pending_greetings):
     """
-    Daily job: read SFTP CSV exports, identify surveys by filename, send
+    Queues one phone's reminders (and first-time greetings) for this run. When
+    the phone would get more than one message, for example when patients share
+    the number or several surveys are open, they are folded into a single
+    digest. Each (patient, survey) row is still kept for dedupe and
+    bookkeeping. Returns 1 if a digest was queued, else 0.
+    """
+    greet_patients = []
+    for item in items:
+        patient = item['patient']
+        if not patient.greeted and patient.id not in pending_greetings:
+            pending_greetings.add(patient.id)
+            greet_patients.append(patient)
+
+    phone = items[0]['patient'].phone_number
+    members = []
+    for patient in greet_patients:
+        members.append(enqueue_message(phone, build_patient_greeting(patient), 'greeting', patient=patient, commit=False))
+    for item in items:
+        members.append(
+            enqueue_message(
+                phone,
+                _build_survey_reminder_message(item),
+                'survey_reminder',
+                patient=item['patient'],
+                survey_code=item['survey_code'],
+                commit=False,
+            )
+        )
+
+    if len(members) == 1:
+        return 0
+    enqueue_digest(phone, _build_survey_digest_message(items, greet_patients), members, patient=items[0]['patient'])
+    return 1
+
+
+def send_daily_survey_reminders(app, plan_only=False):
+    """
+    Daily job: read SFTP CSV exports, identify surveys by filename, queue
     reminders per survey to non-responders, stop after 7 unanswered attempts,
-    and escalate to staff over WhatsApp once.
+    and escalate to staff over WhatsApp once. outbox_worker.py does the sending.
+    plan_only=True parses the exports and plans, but writes nothing and
+    returns the plan report instead.
     """
     with app.app_context():
-        sync_result = sync_sftp_responses()
-        survey_codes = sync_result['survey_codes']
+        return _run_reminder_job('survey_reminders', _queue_daily_survey_reminders, plan_only)
 
-        if not survey_codes:
-            print('Survey reminder skipped: no SFTP CSV surveys found.')
-            return
 
+def _queue_daily_survey_reminders(profile, dry_run=False):
+    with profile.stage('sync'):
+        sync_result = sync_sftp_responses(dry_run=dry_run)
+    # Report the directory scan and ledger checks apart from parsing/ingest.
+    sync_seconds = profile.timings.pop('sync')
+    profile.timings['csv_scan'] = sync_result['scan_seconds']
+    profile.timings['sync'] = round(max(0.0, sync_seconds - sync_result['scan_seconds']), 4)
+    pending_responses = sync_result.pop('pending_responses', {})
+    profile.details['sync'] = sync_result
+    survey_codes = sync_result['survey_codes']
+
+    if not survey_codes:
+        print('Survey reminder skipped: no SFTP CSV surveys found.')
+        return
+
+    with profile.stage('planning'):
         link_map, default_link = _get_survey_link_config()
         today = today_gmt8()
         patients = Patient.query.filter(
@@ -374,87 +1410,140 @@ def send_daily_survey_reminders(app):
         ).all()
         staff_alert_numbers = _get_staff_alert_numbers()
 
-        client = BaileysClient()
-        total_sent = 0
+        state = _load_survey_reminder_state(survey_codes, today)
+        # Dry runs do not ingest, so count what the sync would have added.
+        for survey_code, pids in pending_responses.items():
+            state['responded'].setdefault(survey_code, set()).update(pid.strip().upper() for pid in pids)
+        plan = _plan_survey_reminders(survey_codes, patients, state, link_map, default_link)
+
+        pending_greetings = undelivered_ids('greeting')
+        queued_by_survey = {survey_code: 0 for survey_code in survey_codes}
         total_escalated = 0
+        reminders_by_phone = {}
+        for item in plan:
+            if item['action'] == 'escalate':
+                total_escalated += _alert_staff_for_stalled_patient(item, staff_alert_numbers)
+                continue
+
+            patient = item['patient']
+            phone_key = patient.phone_lookup_hash or hash_data(patient.phone_number)
+            reminders_by_phone.setdefault(phone_key, []).append(item)
+            queued_by_survey[item['survey_code']] += 1
+
+        digests = 0
+        for items in reminders_by_phone.values():
+            digests += _queue_survey_reminders_for_phone(items, pending_greetings)
 
-        for survey_code in survey_codes:
-            responded_pids = {
-                row.pid.strip().upper()
-                for row in QualtricsResponse.query.filter_by(survey_code=survey_code).with_entities(QualtricsResponse.pid).all()
-                if row.pid
-            }
-
-            survey_link = link_map.get(survey_code) or default_link
-            sent_count = 0
-
-            for patient in patients:
-                normalized_pid = patient.pid.strip().upper() if patient.pid else None
-                if not normalized_pid:
-                    continue
-
-                if normalized_pid in responded_pids:
-                    continue
-
-                already_sent_today = SurveyReminderEvent.query.filter_by(
-                    patient_id=patient.id,
-                    survey_code=survey_code,
-                    sent_date=today,
-                ).first()
-                if already_sent_today:
-                    continue
-
-                total_previous = SurveyReminderEvent.query.filter_by(
-                    patient_id=patient.id,
-                    survey_code=survey_code,
-                ).count()
-                if total_previous >= MAX_SURVEY_REMINDERS_PER_PATIENT:
-                    existing_escalation = SurveyReminderEscalation.query.filter_by(
-                        patient_id=patient.id,
-                        survey_code=survey_code,
-                    ).first()
-                    if not existing_escalation:
-                        successful_numbers = _alert_staff_for_stalled_patient(
-                            client,
-                            patient,
-                            survey_code,
-                            total_previous,
-                            staff_alert_numbers,
-                        )
-                        if successful_numbers:
-                            db.session.add(
-                                SurveyReminderEscalation(
-                                    patient_id=patient.id,
-                                    survey_code=survey_code,
-                                    reminder_count=total_previous,
-                                    recipients=','.join(successful_numbers),
-                                )
-                            )
-                            db.session.commit()
-                            total_escalated += 1
-                    continue
-
-                send_patient_greeting_if_needed(patient, client)
-                message = f"{patient.name}，請填寫以下問卷。\n"
-                if survey_link:
-                    message += f"\n問卷連結：{survey_link}"
-
-                result = client.send_message(patient.phone_number, message)
-                if result and result.get('status') != 'error':
-                    db.session.add(
-                        SurveyReminderEvent(
-                            patient_id=patient.id,
-                            survey_code=survey_code,
-                            sent_date=today,
-                        )
+    if dry_run:
+        return
+
+    for survey_code in survey_codes:
+        print(f"Survey '{survey_code}' reminder run complete. queued={queued_by_survey[survey_code]}")
+
+    print(
+        f"SFTP survey reminder run complete. synced={sync_result['synced']}, "
+        f"skipped={sync_result['skipped']}, queued={sum(queued_by_survey.values())}, "
+        f"phones={len(reminders_by_phone)}, combined={digests}, escalated={total_escalated}"
+    )
+
+
+def _load_rotation_checkpoint(fingerprint):
+    setting = AppSetting.query.filter_by(setting_key=KEY_ROTATION_CHECKPOINT_KEY).first()
+    if not setting or not setting.setting_value:
+        return {}
+    try:
+        data = json.loads(setting.setting_value)
+    except json.JSONDecodeError:
+        return {}
+    # A checkpoint left by a rotation to a different key is stale.
+    if data.get('key') != fingerprint:
+        return {}
+    return data.get('tables', {})
+
+
+def _save_rotation_checkpoint(fingerprint, tables):
+    value = json.dumps({'key': fingerprint, 'tables': tables})
+    setting = AppSetting.query.filter_by(setting_key=KEY_ROTATION_CHECKPOINT_KEY).first()
+    if setting:
+        setting.setting_value = value
+    else:
+        db.session.add(AppSetting(setting_key=KEY_ROTATION_CHECKPOINT_KEY, setting_value=value))
+
+
+def rotate_encryption_keys(app, batch_size=KEY_ROTATION_BATCH_SIZE):
+    """
+    Re-encrypts every encrypted column under the current ENCRYPTION_KEY.
+    Rows are walked in keyset-paginated batches on id with one commit per
+    batch, and progress is checkpointed in AppSetting so an interrupted run
+    resumes where it stopped. Values already under the current key are left
+    untouched; values no configured key can decrypt are counted as failed.
+    """
+    with app.app_context():
+        keyring = get_keyring()
+        if keyring is None:
+            raise ValueError('ENCRYPTION_KEY is not set.')
+
+        fingerprint = hashlib.sha256(os.getenv('ENCRYPTION_KEY', '').encode('utf-8')).hexdigest()[:16]
+        checkpoint = _load_rotation_checkpoint(fingerprint)
+        result = {'rotated': 0, 'unchanged': 0, 'failed': 0, 'batches': 0}
+
+        for table, columns in ENCRYPTED_COLUMNS:
+            last_id = checkpoint.get(table, 0)
+            if last_id is None:
+                continue  # table already finished for this key
+
+            select_sql = text(
+                f"SELECT id, {', '.join(columns)} FROM {table} "
+                "WHERE id > :last_id ORDER BY id LIMIT :limit"
+            )
+            while True:
+                rows = db.session.execute(select_sql, {'last_id': last_id, 'limit': batch_size}).fetchall()
+                if not rows:
+                    break
+
+                updates = []
+                for row in rows:
+                    changed = {}
+                    for col, value in zip(columns, row[1:]):
+                        if value is None:
+                            continue
+                        token = value.encode('utf-8')
+                        try:
+                            keyring.primary.decrypt(token)
+                            result['unchanged'] += 1
+                            continue
+                        except InvalidToken:
+                            pass
+                        try:
+                            changed[col] = keyring.rotate(token).decode('utf-8')
+                            result['rotated'] += 1
+                        except InvalidToken:
+                            result['failed'] += 1
+                    if changed:
+                        updates.append((row[0], changed))
+
+                for row_id, changed in updates:
+                    assignments = ', '.join(f"{col} = :{col}" for col in changed)
+                    db.session.execute(
+                        text(f"UPDATE {table} SET {assignments} WHERE id = :id"),
+                        {'id': row_id, **changed},
                     )
-                    db.session.commit()
-                    sent_count += 1
 
-            total_sent += sent_count
-            print(f"Survey '{survey_code}' reminder run complete. sent={sent_count}")
+                last_id = rows[-1][0]
+                checkpoint[table] = last_id
+                _save_rotation_checkpoint(fingerprint, checkpoint)
+                db.session.commit()
+                result['batches'] += 1
+
+            checkpoint[table] = None
+            _save_rotation_checkpoint(fingerprint, checkpoint)
+            db.session.commit()
+
+        AppSetting.query.filter_by(setting_key=KEY_ROTATION_CHECKPOINT_KEY).delete()
+        db.session.commit()
 
         print(
-            f"SFTP survey reminder run complete. synced={sync_result['synced']}, "
-            f"skipped={sync_result['skipped']}, sent={total_sent}, escalated={total_escalated}"
+            f"Key rotation complete. rotated={result['rotated']}, unchanged={result['unchanged']}, "
+            f"failed={result['failed']}, batches={result['batches']}"
         )
+        return result
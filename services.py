@@ -1,8 +1,19 @@
+import asyncio
+import json
 import requests
 import os
 import urllib.parse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 from datetime import timedelta
 
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
 OPENROUTER_API_URL = 'https://openrouter.ai/api/v1/chat/completions'
 
 
@@ -79,52 +90,170 @@ def generate_google_calendar_link(title, start_dt, description=""):
     
     return f"{base_url}?{urllib.parse.urlencode(params)}"
 
-def send_patient_greeting_if_needed(patient, client=None):
-    """
-    Checks if a patient has been greeted yet. If not, sends an
-    introductory message and marks 'greeted' as True in the database.
-    """
-    if patient.greeted:
-        return False
-        
-    if client is None:
-        client = BaileysClient()
-        
-    greeting = (
-        f"您好 {patient.name}，這裡是診所訊息助理。\n\n"
+def build_patient_greeting(patient):
+    return build_greeting_for_names([patient.name])
+
+def build_greeting_for_names(names):
+    """First-time greeting addressed to every patient sharing one phone."""
+    return (
+        f"您好 {'、'.join(names)}，這裡是診所訊息助理。\n\n"
         "我們會向您發送預約提醒、生日卡與問卷通知。\n"
         "如有任何查詢，請聯絡診所職員。"
     )
-    
-    print(f"Sending first-time greeting to {patient.name} ({patient.phone_number})...")
-    client.send_message(patient.phone_number, greeting)
-    
-    patient.greeted = True
-    from models import db
-    db.session.commit()
-    return True
+
+# One keep-alive connection pool per process, shared by every BaileysClient,
+# so a batch of sends reuses open sockets instead of reconnecting each time.
+_wa_session = None
+_wa_session_lock = threading.Lock()
+
+
+def get_wa_session():
+    global _wa_session
+    with _wa_session_lock:
+        if _wa_session is None:
+            pool_size = max(int(os.getenv('WA_DISPATCH_CONCURRENCY', '4')), 1) * 2
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _wa_session = session
+        return _wa_session
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling wa-service while the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Opens after WA_BREAKER_FAILURES (default 5) consecutive failed calls,
+    meaning 503s, timeouts or refused connections, so callers fail fast
+    instead of paying a round trip each. WA_BREAKER_RESET_SECONDS (default
+    30) after opening, one trial call is let through (half-open). If it
+    reaches wa-service the circuit closes, otherwise it opens again.
+    """
+
+    def __init__(self, failure_threshold=None, reset_seconds=None):
+        if failure_threshold is None:
+            failure_threshold = int(os.getenv('WA_BREAKER_FAILURES', '5'))
+        if reset_seconds is None:
+            reset_seconds = float(os.getenv('WA_BREAKER_RESET_SECONDS', '30'))
+        self.failure_threshold = max(failure_threshold, 1)
+        self.reset_seconds = reset_seconds
+        self.state = 'closed'
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self._opened_at >= self.reset_seconds:
+                self.state = 'half_open'
+                self._trial_in_flight = False
+            if self.state == 'half_open' and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != 'closed':
+                print('wa-service is reachable again; circuit closed.')
+            self.state = 'closed'
+            self._failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == 'half_open' or (self.state == 'closed' and self._failures >= self.failure_threshold):
+                self.state = 'open'
+                self._opened_at = time.monotonic()
+                self._trial_in_flight = False
+                print(
+                    f"wa-service circuit open after {self._failures} consecutive failure(s); "
+                    f"next trial call in {self.reset_seconds:g}s."
+                )
+
+
+# Shared by every client in the process, like the HTTP session.
+_wa_breaker = CircuitBreaker()
+
+
+def get_wa_breaker():
+    return _wa_breaker
+
+
+def _circuit_open_result():
+    # 503 like wa-service's own "not connected", so the outbox retries later.
+    return {"status": "error", "status_code": 503, "error": "wa-service unavailable (circuit open)"}
+
+
+def get_wa_send_batch_size():
+    """WA_SEND_BATCH_SIZE, capped at wa-service's SEND_BATCH_MAX (default 200) so no call is rejected as too large."""
+    batch_max = max(int(os.getenv('SEND_BATCH_MAX', '200')), 1)
+    return min(max(int(os.getenv('WA_SEND_BATCH_SIZE', '50')), 1), batch_max)
+
 
 class BaileysClient:
-    def __init__(self):
+    def __init__(self, session=None):
         self.base_url = 'http://127.0.0.1:3000' # Local Node.js service
         self.api_key = os.getenv('WA_SERVICE_API_KEY', '').strip()
+        self.session = session or get_wa_session()
+        self.breaker = get_wa_breaker()
+        self.batch_supported = True
+
+    def _headers(self):
+        headers = {}
+        if self.api_key:
+            headers['X-Api-Key'] = self.api_key
+        return headers
+
+    def _post(self, path, payload, timeout):
+        """POSTs to wa-service through the circuit breaker; raises CircuitOpenError while it is open."""
+        if not self.breaker.allow():
+            raise CircuitOpenError(path)
+        try:
+            response = self.session.post(f"{self.base_url}{path}", json=payload, headers=self._headers(), timeout=timeout)
+        except requests.exceptions.RequestException:
+            self.breaker.record_failure()
+            raise
+        if response.status_code == 503:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+    def is_ready(self):
+        """
+        GET /ready: True when wa-service is connected to WhatsApp. A wa-service
+        without the endpoint counts as ready and its sends decide. A ready
+        answer also closes the circuit breaker, so batches resume at once.
+        """
+        try:
+            response = self.session.get(f"{self.base_url}/ready", headers=self._headers(), timeout=5)
+        except requests.exceptions.RequestException:
+            # Callers log the deferral; the worker probes every few seconds.
+            return False
+        if response.ok or response.status_code == 404:
+            self.breaker.record_success()
+            return True
+        return False
 
     def send_message(self, phone_number, message):
         """
         Sends a text message using the local Baileys service.
         """
-        url = f"{self.base_url}/send-message"
-        
         payload = {
             "phone": phone_number,
             "message": message
         }
-        headers = {}
-        if self.api_key:
-            headers['X-Api-Key'] = self.api_key
 
         try:
-            response = requests.post(url, json=payload, headers=headers, timeout=15)
+            response = self._post('/send-message', payload, timeout=15)
             try:
                 body = response.json()
             except ValueError:
@@ -140,6 +269,8 @@ class BaileysClient:
                 "status_code": response.status_code,
                 "error": error_message,
             }
+        except CircuitOpenError:
+            return _circuit_open_result()
         except requests.exceptions.RequestException as e:
             print(f"Error sending message to {phone_number}: {e}")
             return {
@@ -147,6 +278,385 @@ class BaileysClient:
                 "error": str(e),
             }
 
+    def send_many(self, messages, stop_phone_on_error=False):
+        """
+        Sends [(phone, message), ...] through /send-batch calls of at most
+        WA_SEND_BATCH_SIZE messages and returns one result per message, in
+        order, shaped like send_message's. A phone with more messages than
+        that gets several calls, one after another. Messages wa-service
+        skipped after an earlier failure to the same phone
+        (stop_phone_on_error) get None. Falls back to send_message when
+        wa-service has no /send-batch.
+        """
+        results = [None] * len(messages)
+        batch_size = get_wa_send_batch_size()
+        for indexes in _chunk_by_phone(messages, batch_size):
+            for call_indexes in _split_chunk(indexes, batch_size):
+                chunk = [messages[i] for i in call_indexes]
+                if self.batch_supported:
+                    chunk_results = self._post_batch(chunk, stop_phone_on_error)
+                # Not elif: _post_batch clears batch_supported on an old wa-service.
+                if not self.batch_supported:
+                    chunk_results = self._send_one_by_one(chunk, stop_phone_on_error)
+                for i, result in zip(call_indexes, chunk_results):
+                    results[i] = result
+                if stop_phone_on_error and _chunk_failed(chunk_results):
+                    break
+        return results
+
+    def lookup_numbers(self, phone_numbers, chunk_size=500):
+        """
+        Asks wa-service (POST /lookup-batch, backed by its existence cache)
+        which numbers are on WhatsApp. Returns {phone: True/False}; numbers
+        wa-service could not check, or all of them if it is unreachable,
+        are left out.
+        """
+        phones = list(dict.fromkeys(str(phone) for phone in phone_numbers if phone))
+        found = {}
+        for start in range(0, len(phones), chunk_size):
+            chunk = phones[start:start + chunk_size]
+            try:
+                response = self._post('/lookup-batch', {"phones": chunk}, timeout=(5, 15 + len(chunk)))
+                body = response.json() if response.ok else None
+            except CircuitOpenError:
+                print(f"Number lookup skipped for {len(chunk)} phone(s): wa-service circuit open")
+                continue
+            except (requests.exceptions.RequestException, ValueError) as e:
+                print(f"Number lookup failed for {len(chunk)} phone(s): {e}")
+                continue
+            if not isinstance(body, dict):
+                print(f"Number lookup failed for {len(chunk)} phone(s): HTTP {response.status_code}")
+                continue
+            for phone, exists in (body.get('results') or {}).items():
+                if exists is not None:
+                    found[phone] = bool(exists)
+        return found
+
+    def _post_batch(self, messages, stop_phone_on_error):
+        payload = {
+            "messages": [{"phone": phone, "message": message} for phone, message in messages],
+            "stopPhoneOnError": stop_phone_on_error,
+        }
+        # wa-service sends a phone's messages one after another, so allow for
+        # a slow lookup on each of them before giving up on the whole batch.
+        timeout = (5, 15 + 10 * len(messages))
+
+        try:
+            response = self._post('/send-batch', payload, timeout=timeout)
+        except CircuitOpenError:
+            return [_circuit_open_result() for _ in messages]
+        except requests.exceptions.RequestException as e:
+            print(f"Error sending batch of {len(messages)} messages: {e}")
+            return [{"status": "error", "error": str(e)} for _ in messages]
+
+        try:
+            body = response.json()
+        except ValueError:
+            body = None
+
+        if response.status_code == 404 and not isinstance(body, dict):
+            print("wa-service has no /send-batch endpoint; sending messages one at a time.")
+            self.batch_supported = False
+            return []
+
+        if response.ok and isinstance(body, dict) and len(body.get('results') or []) == len(messages):
+            return [None if item.get('status') == 'skipped' else item for item in body['results']]
+
+        if isinstance(body, dict) and body.get('error'):
+            error_message = body['error']
+        else:
+            error_message = response.text or "Unexpected /send-batch response"
+        print(f"Failed sending batch of {len(messages)} messages: HTTP {response.status_code} - {error_message}")
+        return [
+            {"status": "error", "status_code": response.status_code, "error": error_message}
+            for _ in messages
+        ]
+
+    def _send_one_by_one(self, messages, stop_phone_on_error):
+        results = []
+        failed_phones = set()
+        for phone, message in messages:
+            if phone in failed_phones:
+                results.append(None)
+                continue
+            result = self.send_message(phone, message) or {"status": "error", "error": "No response"}
+            if stop_phone_on_error and result.get('status') == 'error':
+                failed_phones.add(phone)
+            results.append(result)
+        return results
+
+
+def _chunk_by_phone(messages, batch_size):
+    """
+    Splits message indexes into chunks of about batch_size, never splitting
+    one phone's messages. A phone with more than batch_size messages gets a
+    chunk of its own; _split_chunk cuts it into sequential calls.
+    """
+    by_phone = {}
+    for i, (phone, _) in enumerate(messages):
+        by_phone.setdefault(phone, []).append(i)
+
+    chunks = []
+    current = []
+    for indexes in by_phone.values():
+        if current and len(current) + len(indexes) > batch_size:
+            chunks.append(current)
+            current = []
+        current.extend(indexes)
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _split_chunk(indexes, batch_size):
+    """Consecutive slices of a _chunk_by_phone chunk, each small enough for one /send-batch call."""
+    return [indexes[start:start + batch_size] for start in range(0, len(indexes), batch_size)]
+
+
+def _chunk_failed(results):
+    """True when a /send-batch call failed or skipped a message."""
+    return any(result is None or result.get('status') == 'error' for result in results)
+
+
+def iter_dispatch_messages(client, messages, concurrency=None, stop_phone_on_error=False):
+    """
+    Sends [(phone, message), ...] through client.send_many in chunks of
+    WA_SEND_BATCH_SIZE, with at most `concurrency` chunks in flight
+    (WA_DISPATCH_CONCURRENCY, default 4), and yields (index, result) as each
+    chunk finishes. A phone's messages always travel in the same chunk and
+    wa-service sends them in list order, so a greeting still arrives before
+    the reminder that follows it. With stop_phone_on_error, messages after a
+    failed one to the same phone are not attempted and are yielded with
+    result None. Runs no database code; callers apply bookkeeping on their
+    own thread.
+    """
+    if concurrency is None:
+        concurrency = int(os.getenv('WA_DISPATCH_CONCURRENCY', '4'))
+    chunks = _chunk_by_phone(messages, get_wa_send_batch_size())
+
+    def send_chunk(indexes):
+        results = client.send_many([messages[i] for i in indexes], stop_phone_on_error=stop_phone_on_error)
+        return list(zip(indexes, results))
+
+    if concurrency <= 1 or len(chunks) <= 1:
+        for indexes in chunks:
+            yield from send_chunk(indexes)
+        return
+
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(chunks))) as pool:
+        futures = [pool.submit(send_chunk, indexes) for indexes in chunks]
+        for future in as_completed(futures):
+            yield from future.result()
+
+
+class AsyncBaileysClient:
+    """
+    asyncio counterpart of BaileysClient: same result dicts, one pooled
+    aiohttp session, and at most `concurrency` wa-service calls in flight
+    (WA_DISPATCH_CONCURRENCY, default 4). Every call accepts a `timeout` in
+    seconds. Use as `async with AsyncBaileysClient() as client:` inside the
+    event loop that will run the sends.
+    """
+
+    def __init__(self, concurrency=None, timeout=15):
+        if aiohttp is None:
+            raise RuntimeError('AsyncBaileysClient needs aiohttp (pip install aiohttp).')
+        if concurrency is None:
+            concurrency = int(os.getenv('WA_DISPATCH_CONCURRENCY', '4'))
+        self.base_url = 'http://127.0.0.1:3000' # Local Node.js service
+        self.api_key = os.getenv('WA_SERVICE_API_KEY', '').strip()
+        self.concurrency = max(concurrency, 1)
+        self.timeout = timeout
+        self.breaker = get_wa_breaker()
+        self.batch_supported = True
+        self._http = None
+        self._slots = asyncio.Semaphore(self.concurrency)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
+        return False
+
+    async def aclose(self):
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
+
+    def _open_session(self):
+        # aiohttp sessions belong to the running loop, so create on first use.
+        self._http = aiohttp.ClientSession(
+            base_url=self.base_url,
+            headers={'X-Api-Key': self.api_key} if self.api_key else None,
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+        )
+
+    async def _post(self, path, payload, timeout):
+        """
+        POSTs JSON through the circuit breaker; returns (status, ok, body or
+        None, text), or raises CircuitOpenError while the circuit is open.
+        """
+        if self._http is None:
+            self._open_session()
+        async with self._slots:
+            # Checked once a slot is free, so queued calls see a circuit that opened meanwhile.
+            if not self.breaker.allow():
+                raise CircuitOpenError(path)
+            try:
+                async with self._http.post(
+                    path, json=payload, timeout=aiohttp.ClientTimeout(total=timeout, connect=5)
+                ) as response:
+                    text = await response.text()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                self.breaker.record_failure()
+                raise
+        if response.status == 503:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        try:
+            body = json.loads(text)
+        except ValueError:
+            body = None
+        return response.status, response.ok, body, text
+
+    async def is_ready(self):
+        """Async BaileysClient.is_ready: GET /ready, which also closes the breaker when ready."""
+        if self._http is None:
+            self._open_session()
+        try:
+            async with self._http.get('/ready', timeout=aiohttp.ClientTimeout(total=5)) as response:
+                status_code = response.status
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return False
+        if status_code < 400 or status_code == 404:
+            self.breaker.record_success()
+            return True
+        return False
+
+    async def send_message(self, phone_number, message, timeout=None):
+        """Sends one text message; returns the same dict as BaileysClient.send_message."""
+        try:
+            status_code, ok, body, text = await self._post(
+                '/send-message', {"phone": phone_number, "message": message}, timeout or self.timeout
+            )
+        except CircuitOpenError:
+            return _circuit_open_result()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error_message = str(e) or type(e).__name__
+            print(f"Error sending message to {phone_number}: {error_message}")
+            return {"status": "error", "error": error_message}
+
+        if body is None:
+            body = {"error": text}
+
+        if ok:
+            return body
+
+        error_message = body.get('error') if isinstance(body, dict) else str(body)
+        print(f"Failed sending to {phone_number}: HTTP {status_code} - {error_message}")
+        return {
+            "status": "error",
+            "status_code": status_code,
+            "error": error_message,
+        }
+
+    async def send_many(self, messages, stop_phone_on_error=False, timeout=None):
+        """
+        Sends [(phone, message), ...] as concurrent /send-batch calls of up
+        to WA_SEND_BATCH_SIZE messages and returns results in input order,
+        like BaileysClient.send_many. A phone's calls never overlap.
+        """
+        results = [None] * len(messages)
+        batch_size = get_wa_send_batch_size()
+
+        async def send_chunk(indexes):
+            # Oversized single-phone chunks go out as sequential calls.
+            for call_indexes in _split_chunk(indexes, batch_size):
+                chunk = [messages[i] for i in call_indexes]
+                chunk_results = None
+                if self.batch_supported:
+                    chunk_results = await self._post_batch(chunk, stop_phone_on_error, timeout)
+                if chunk_results is None:
+                    chunk_results = await self._send_one_by_one(chunk, stop_phone_on_error, timeout)
+                for i, result in zip(call_indexes, chunk_results):
+                    results[i] = result
+                if stop_phone_on_error and _chunk_failed(chunk_results):
+                    return
+
+        await asyncio.gather(*(send_chunk(indexes) for indexes in _chunk_by_phone(messages, batch_size)))
+        return results
+
+    async def _post_batch(self, messages, stop_phone_on_error, timeout):
+        """Returns per-message results, or None when wa-service has no /send-batch."""
+        payload = {
+            "messages": [{"phone": phone, "message": message} for phone, message in messages],
+            "stopPhoneOnError": stop_phone_on_error,
+        }
+        try:
+            status_code, ok, body, text = await self._post(
+                '/send-batch', payload, timeout or 15 + 10 * len(messages)
+            )
+        except CircuitOpenError:
+            return [_circuit_open_result() for _ in messages]
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error_message = str(e) or type(e).__name__
+            print(f"Error sending batch of {len(messages)} messages: {error_message}")
+            return [{"status": "error", "error": error_message} for _ in messages]
+
+        if status_code == 404 and not isinstance(body, dict):
+            print("wa-service has no /send-batch endpoint; sending messages one at a time.")
+            self.batch_supported = False
+            return None
+
+        if ok and isinstance(body, dict) and len(body.get('results') or []) == len(messages):
+            return [None if item.get('status') == 'skipped' else item for item in body['results']]
+
+        if isinstance(body, dict) and body.get('error'):
+            error_message = body['error']
+        else:
+            error_message = text or "Unexpected /send-batch response"
+        print(f"Failed sending batch of {len(messages)} messages: HTTP {status_code} - {error_message}")
+        return [
+            {"status": "error", "status_code": status_code, "error": error_message}
+            for _ in messages
+        ]
+
+    async def _send_one_by_one(self, messages, stop_phone_on_error, timeout):
+        results = [None] * len(messages)
+        by_phone = {}
+        for i, (phone, _) in enumerate(messages):
+            by_phone.setdefault(phone, []).append(i)
+
+        async def send_in_order(indexes):
+            for i in indexes:
+                phone, message = messages[i]
+                result = await self.send_message(phone, message, timeout) or {"status": "error", "error": "No response"}
+                results[i] = result
+                if stop_phone_on_error and result.get('status') == 'error':
+                    return
+
+        await asyncio.gather(*(send_in_order(indexes) for indexes in by_phone.values()))
+        return results
+
+
+async def aiter_dispatch_messages(client, messages, stop_phone_on_error=False):
+    """
+    Event-loop version of iter_dispatch_messages for an AsyncBaileysClient:
+    every chunk is started at once, the client's semaphore bounds how many
+    calls are in flight, and (index, result) pairs are yielded as each
+    chunk finishes.
+    """
+    async def send_chunk(indexes):
+        results = await client.send_many([messages[i] for i in indexes], stop_phone_on_error=stop_phone_on_error)
+        return list(zip(indexes, results))
+
+    chunks = _chunk_by_phone(messages, get_wa_send_batch_size())
+    for finished in asyncio.as_completed([send_chunk(indexes) for indexes in chunks]):
+        for item in await finished:
+            yield item
+
 
 class QualtricsClient:
     """Minimal Qualtrics responses client for PID matching workflows."""
@@ -0,0 +1,128 @@
+"""
+Ingest Qualtrics SFTP uploads within seconds of them landing, instead of
+waiting for the 09:00 survey job. Uses inotify (via watchdog) when available
+and falls back to polling the upload folder.
+"""
+import os
+import threading
+import time
+
+from app import app
+from models import db
+import scheduler_tasks
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler = object
+    Observer = None
+
+
+# A file must keep the same (size, mtime) this long before it is ingested,
+# so exports still being written over SFTP are not picked up half-way.
+SETTLE_SECONDS = float(os.getenv('SFTP_WATCH_SETTLE_SECONDS', '3'))
+# Rescan interval when inotify is unavailable; with inotify it is only a safety net.
+POLL_SECONDS = float(os.getenv('SFTP_WATCH_POLL_SECONDS', '5'))
+INOTIFY_SAFETY_POLL_SECONDS = 300
+
+
+def _snapshot(upload_dir):
+    signatures = {}
+    try:
+        with os.scandir(upload_dir) as it:
+            for entry in it:
+                if not entry.name.endswith('.csv') or not entry.is_file():
+                    continue
+                try:
+                    stat_result = entry.stat()
+                except FileNotFoundError:
+                    continue
+                signatures[entry.path] = (stat_result.st_size, stat_result.st_mtime_ns)
+    except FileNotFoundError:
+        pass
+    return signatures
+
+
+class _WakeOnChange(FileSystemEventHandler):
+    def __init__(self, wake_event):
+        self._wake_event = wake_event
+
+    def on_any_event(self, event):
+        self._wake_event.set()
+
+
+def ingest_uploads(paths=None):
+    with app.app_context():
+        result = scheduler_tasks.sync_sftp_responses(paths=paths)
+    print(
+        f"SFTP watcher ingest: files={result['files_ingested']}, synced={result['synced']}, "
+        f"skipped={result['skipped']}, rows_per_sec={result['rows_per_sec']}"
+    )
+    return result
+
+
+def watch(upload_dir=None, on_stable=ingest_uploads):
+    upload_dir = str(upload_dir or scheduler_tasks._get_sftp_upload_dir())
+    wake = threading.Event()
+    observer = None
+    poll_seconds = POLL_SECONDS
+
+    if Observer is not None and os.path.isdir(upload_dir):
+        observer = Observer()
+        observer.schedule(_WakeOnChange(wake), upload_dir, recursive=False)
+        observer.start()
+        poll_seconds = INOTIFY_SAFETY_POLL_SECONDS
+        print(f"SFTP watcher: watching {upload_dir} with inotify.")
+    else:
+        print(f"SFTP watcher: polling {upload_dir} every {POLL_SECONDS:g}s.")
+
+    ingested = {}
+    pending = {}  # path -> (signature, time the signature was first seen)
+
+    try:
+        while True:
+            wake.wait(SETTLE_SECONDS if pending else poll_seconds)
+            wake.clear()
+
+            now = time.monotonic()
+            current = _snapshot(upload_dir)
+            for path, signature in current.items():
+                if ingested.get(path) == signature:
+                    pending.pop(path, None)
+                elif pending.get(path, (None,))[0] != signature:
+                    pending[path] = (signature, now)
+            for path in list(pending):
+                if path not in current:
+                    pending.pop(path)
+            for path in list(ingested):
+                if path not in current:
+                    ingested.pop(path)
+
+            ready = [path for path, (_, seen_at) in pending.items() if now - seen_at >= SETTLE_SECONDS]
+            if not ready:
+                continue
+
+            try:
+                # Only settled files: others may still be mid-upload.
+                on_stable(ready)
+            except Exception as e:
+                print(f"SFTP watcher ingest failed: {e}")
+                continue
+
+            for path in ready:
+                ingested[path] = pending.pop(path)[0]
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join()
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        db.create_all()
+
+    try:
+        watch()
+    except KeyboardInterrupt:
+        pass
@@ -17,6 +17,10 @@ echo Starting WhatsApp Health Bot Services...
 echo Starting Flask App...
 start "Flask App" cmd /k ""%PYTHON_EXE%" "%~dp0app.py""
 
+:: Start Outbox Worker (delivers queued WhatsApp messages)
+echo Starting Outbox Worker...
+start "Outbox Worker" cmd /k ""%PYTHON_EXE%" "%~dp0outbox_worker.py""
+
 :: Start Node.js WhatsApp Service
 echo Starting WhatsApp Service...
 cd wa-service
@@ -0,0 +1,53 @@
+import os
+import sys
+from contextlib import contextmanager
+from pathlib import Path
+
+import pytest
+from cryptography.fernet import Fernet
+from flask import Flask
+from sqlalchemy import event
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault('ENCRYPTION_KEY', Fernet.generate_key().decode())
+
+from models import db  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """A bare Flask app on an in-memory SQLite database, with an app context pushed."""
+    monkeypatch.setenv('SFTP_UPLOAD_DIR', str(tmp_path / 'uploads'))
+    monkeypatch.setenv('SFTP_SYNC_LOCK_FILE', str(tmp_path / 'sftp_sync.lock'))
+    (tmp_path / 'uploads').mkdir()
+
+    test_app = Flask(__name__)
+    test_app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    test_app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(test_app)
+    with test_app.app_context():
+        db.create_all()
+        yield test_app
+        db.session.remove()
+
+
+@pytest.fixture
+def count_queries(app):
+    """
+    count_queries() is a context manager yielding the list of SQL statements
+    executed inside it, collected with a before_cursor_execute listener.
+    """
+    @contextmanager
+    def counter():
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+    return counter
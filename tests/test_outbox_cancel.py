@@ -0,0 +1,50 @@
+from models import db, OutboundMessage, Patient
+from outbox import PATIENT_DELETED_REASON, cancel_undelivered, enqueue_digest, enqueue_message, requeue_dead_messages, scrub_patient_messages
+
+
+def _patient(pid, phone):
+    patient = Patient(pid=pid, name=f'Patient {pid}', send_survey_reminders=True)
+    patient.phone_number = phone
+    db.session.add(patient)
+    db.session.commit()
+    return patient
+
+
+def test_requeue_leaves_cancelled_messages_alone(app):
+    deleted = _patient('P01', '85291111111')
+    other = _patient('P02', '85292222222')
+    reminder = enqueue_message(deleted.phone_number, 'Reminder for P01', 'survey_reminder', patient=deleted, commit=False)
+    digest = enqueue_digest(deleted.phone_number, 'Digest for P01', [reminder], patient=deleted)
+    failed = enqueue_message(other.phone_number, 'Reminder for P02', 'survey_reminder', patient=other, commit=False)
+    failed.status = 'dead'
+    db.session.commit()
+
+    cancel_undelivered(PATIENT_DELETED_REASON, patient_id=deleted.id)
+    db.session.commit()
+    requeue_dead_messages()
+
+    statuses = {row.id: row.status for row in OutboundMessage.query}
+    assert statuses == {reminder.id: 'cancelled', digest.id: 'cancelled', failed.id: 'pending'}
+
+
+def test_scrub_removes_phone_and_text_of_deleted_patient(app):
+    deleted = _patient('P01', '85291111111')
+    other = _patient('P02', '85291111111-2')
+    sent = enqueue_message(deleted.phone_number, 'Hello Patient P01', 'greeting', patient=deleted, commit=False)
+    sent.status = 'sent'
+    dead = enqueue_message(deleted.phone_number, 'Reminder for Patient P01', 'survey_reminder', patient=deleted, commit=False)
+    kept = enqueue_message(other.phone_number, 'Reminder for Patient P02', 'survey_reminder', patient=other, commit=False)
+    digest = enqueue_digest(deleted.phone_number, 'Patient P01 and Patient P02', [dead, kept])
+    for row in (dead, kept, digest):
+        row.status = 'dead'
+    db.session.commit()
+
+    scrub_patient_messages(deleted.id)
+    db.session.commit()
+    requeue_dead_messages()
+    db.session.expire_all()
+
+    for row in (sent, dead, digest):
+        assert row.phone_number == '' and row.message == ''
+    assert kept.message == 'Reminder for Patient P02'
+    assert [sent.status, dead.status, kept.status, digest.status] == ['sent', 'cancelled', 'cancelled', 'cancelled']
@@ -0,0 +1,36 @@
+import pytest
+
+from models import db, Patient
+from app import _list_patients_by_pid
+
+
+def _seed_patients():
+    for i in range(40):
+        # Every fifth patient has no PID; PID order differs from id order.
+        pid = None if i % 5 == 0 else f'P{(i * 37) % 100:03d}'
+        patient = Patient(pid=pid, name=f'Patient {i}', send_survey_reminders=True)
+        patient.phone_number = f'8529{i:07d}'
+        db.session.add(patient)
+    db.session.commit()
+
+
+@pytest.mark.parametrize('descending', [False, True])
+def test_pid_pages_walk_every_patient_in_order(app, descending):
+    _seed_patients()
+    patients = Patient.query.all()
+    expected = sorted((p for p in patients if p.pid), key=lambda p: (p.pid, p.id))
+    expected += sorted((p for p in patients if not p.pid), key=lambda p: p.id)
+    if descending:
+        expected.reverse()
+
+    seen = []
+    after = None
+    while True:
+        rows = _list_patients_by_pid(Patient.query, descending, after, 7 + 1)
+        page = rows[:7]
+        seen += page
+        if len(rows) <= 7:
+            break
+        after = (page[-1].pid, page[-1].id)
+
+    assert [p.id for p in seen] == [p.id for p in expected]
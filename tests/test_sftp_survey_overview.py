@@ -0,0 +1,46 @@
+import csv
+import os
+
+from models import db, QualtricsResponse
+import scheduler_tasks
+
+
+def _write_export(path, heading, rows):
+    with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['StartDate', 'EndDate', 'RecordedDate', 'ResponseId', 'Q1_6'])
+        writer.writerow(['Start Date', 'End Date', 'Recorded Date', 'Response ID', f'{heading}\n請輸入PID'])
+        writer.writerow(['{"ImportId":"startDate"}', '{"ImportId":"endDate"}', '{"ImportId":"recordedDate"}', '{"ImportId":"_recordId"}', '{"ImportId":"QID1_6"}'])
+        for i in range(rows):
+            writer.writerow(['2026-03-15 10:00:00', '2026-03-15 10:05:00', '2026-03-15T10:05:00Z', f'R_{i}', f'P{i:02d}'])
+
+
+def _overview_queries(count_queries, file_count):
+    upload_dir = scheduler_tasks._get_sftp_upload_dir()
+    for n in range(file_count):
+        _write_export(upload_dir / f'Survey {n}.csv', f'問卷{n}', rows=3)
+        for i in range(3):
+            db.session.add(QualtricsResponse(survey_code=f'問卷{n}', pid=f'P{i:02d}', qualtrics_response_id=f'{n}:R_{i}'))
+    db.session.commit()
+
+    # The first call parses the exports and caches their metadata.
+    scheduler_tasks.get_sftp_survey_overview()
+    with count_queries() as statements:
+        overview = scheduler_tasks.get_sftp_survey_overview()
+    assert len(overview) == file_count
+    assert all(item['response_count'] == 3 for item in overview)
+    return len(statements)
+
+
+def test_overview_query_count_is_constant(app, count_queries, monkeypatch):
+    monkeypatch.setenv('SFTP_PARSE_WORKERS', '1')
+    small = _overview_queries(count_queries, file_count=1)
+
+    db.drop_all()
+    db.create_all()
+    for path in scheduler_tasks._get_sftp_upload_dir().iterdir():
+        os.remove(path)
+    large = _overview_queries(count_queries, file_count=12)
+
+    # Cached metadata, archived metadata, link overrides and one GROUP BY for counts.
+    assert small == large == 4
@@ -0,0 +1,52 @@
+from models import db, Patient, QualtricsResponse, SurveyReminderEscalation, SurveyReminderEvent
+import scheduler_tasks
+from time_utils import today_gmt8
+
+
+def _seed(patient_count, survey_codes):
+    today = today_gmt8()
+    patients = []
+    for i in range(patient_count):
+        patient = Patient(pid=f'P{i:04d}', name=f'Patient {i}', send_survey_reminders=True)
+        patient.phone_number = f'8525{i:07d}'
+        patients.append(patient)
+    db.session.add_all(patients)
+    db.session.flush()
+
+    for n, survey_code in enumerate(survey_codes):
+        for i, patient in enumerate(patients):
+            if i % 3 == 0:
+                db.session.add(QualtricsResponse(
+                    survey_code=survey_code,
+                    pid=patient.pid,
+                    qualtrics_response_id=f'{survey_code}:R_{i}',
+                ))
+            elif i % 3 == 1:
+                db.session.add(SurveyReminderEvent(patient_id=patient.id, survey_code=survey_code, sent_date=today))
+            elif i % 5 == 0:
+                db.session.add(SurveyReminderEscalation(patient_id=patient.id, survey_code=survey_code, reminder_count=7))
+    db.session.commit()
+
+
+def _planning_queries(count_queries, patient_count, survey_count):
+    survey_codes = [f'Survey {n}' for n in range(survey_count)]
+    _seed(patient_count, survey_codes)
+    with count_queries() as statements:
+        patients = Patient.query.filter(
+            Patient.send_survey_reminders == True,
+            Patient.pid.isnot(None),
+        ).all()
+        state = scheduler_tasks._load_survey_reminder_state(survey_codes, today_gmt8())
+        plan = scheduler_tasks._plan_survey_reminders(survey_codes, patients, state, {}, '')
+    assert plan
+    return len(statements)
+
+
+def test_planning_query_count_is_constant(app, count_queries):
+    small = _planning_queries(count_queries, patient_count=3, survey_count=1)
+    db.drop_all()
+    db.create_all()
+    large = _planning_queries(count_queries, patient_count=60, survey_count=8)
+
+    # The patient query plus one grouped query per kind of reminder state.
+    assert small == large == 6
@@ -12,10 +12,11 @@ const express = require('express');
 const bodyParser = require('body-parser');
 const qrcode = require('qrcode-terminal');
 const fs = require('fs');
+const crypto = require('crypto');
 const axios = require('axios');
 
 const app = express();
-app.use(bodyParser.json());
+app.use(bodyParser.json({ limit: '1mb' }));
 
 const PORT = Number(process.env.PORT || 3000);
 const HOST = process.env.HOST || '127.0.0.1';
@@ -23,10 +24,149 @@ const HOST = process.env.HOST || '127.0.0.1';
 const BOT_WEBHOOK_URL = process.env.BOT_WEBHOOK_URL || 'http://127.0.0.1:5000/webhook/whatsapp';
 const WA_SERVICE_API_KEY = (process.env.WA_SERVICE_API_KEY || '').trim();
 const WEBHOOK_TOKEN = (process.env.WHATSAPP_WEBHOOK_TOKEN || '').trim();
+// Limits for /send-batch: items per request, and phones sent to in parallel
+const SEND_BATCH_MAX = Number(process.env.SEND_BATCH_MAX || 200);
+const SEND_BATCH_CONCURRENCY = Number(process.env.SEND_BATCH_CONCURRENCY || 4);
+const LOOKUP_BATCH_MAX = Number(process.env.LOOKUP_BATCH_MAX || 500);
+// onWhatsApp results are cached on disk; unregistered numbers for a shorter time
+// so a patient who joins WhatsApp is picked up again the same day.
+const EXISTENCE_CACHE_FILE = process.env.EXISTENCE_CACHE_FILE || 'existence_cache.json';
+const EXISTENCE_CACHE_TTL_MS = Number(process.env.EXISTENCE_CACHE_TTL_HOURS || 168) * 3600 * 1000;
+const EXISTENCE_CACHE_NEGATIVE_TTL_MS = Number(process.env.EXISTENCE_CACHE_NEGATIVE_TTL_HOURS || 12) * 3600 * 1000;
+const ON_WHATSAPP_TIMEOUT_MS = 8000;
+const ON_WHATSAPP_CHUNK = 50;
 
 let sock;
 let isWhatsAppReady = false;
 
+// Existence cache: keyed by an HMAC of the number so the file holds no phone numbers.
+const existenceCache = new Map(); // key -> { exists, checkedAt }
+const existenceLookups = new Map(); // phone -> in-flight lookup promise
+let existenceCacheSaveTimer = null;
+
+function existenceKey(phone) {
+    return crypto.createHmac('sha256', WA_SERVICE_API_KEY || 'wa-service').update(String(phone)).digest('hex');
+}
+
+function loadExistenceCache() {
+    try {
+        const entries = JSON.parse(fs.readFileSync(EXISTENCE_CACHE_FILE, 'utf8'));
+        for (const [key, entry] of Object.entries(entries)) {
+            existenceCache.set(key, entry);
+        }
+        console.log(`Loaded ${existenceCache.size} cached number lookups.`);
+    } catch (e) {
+        if (e.code !== 'ENOENT') {
+            console.error('Failed to load existence cache:', e.message);
+        }
+    }
+}
+
+function saveExistenceCacheSoon() {
+    if (existenceCacheSaveTimer) {
+        return;
+    }
+    existenceCacheSaveTimer = setTimeout(() => {
+        existenceCacheSaveTimer = null;
+        const now = Date.now();
+        const entries = {};
+        for (const [key, entry] of existenceCache) {
+            if (isFresh(entry, now)) {
+                entries[key] = entry;
+            } else {
+                existenceCache.delete(key);
+            }
+        }
+        const tmpFile = `${EXISTENCE_CACHE_FILE}.tmp`;
+        try {
+            fs.writeFileSync(tmpFile, JSON.stringify(entries));
+            fs.renameSync(tmpFile, EXISTENCE_CACHE_FILE);
+        } catch (e) {
+            console.error('Failed to save existence cache:', e.message);
+        }
+    }, 2000);
+}
+
+function isFresh(entry, now) {
+    const ttl = entry.exists ? EXISTENCE_CACHE_TTL_MS : EXISTENCE_CACHE_NEGATIVE_TTL_MS;
+    return now - entry.checkedAt < ttl;
+}
+
+function getCachedExistence(phone) {
+    const entry = existenceCache.get(existenceKey(phone));
+    return entry && isFresh(entry, Date.now()) ? entry.exists : undefined;
+}
+
+function rememberExistence(phone, exists) {
+    existenceCache.set(existenceKey(phone), { exists, checkedAt: Date.now() });
+    saveExistenceCacheSoon();
+}
+
+function digitsOf(phone) {
+    return String(phone).replace(/\D/g, '');
+}
+
+// Asks WhatsApp about up to ON_WHATSAPP_CHUNK numbers in one query.
+async function queryOnWhatsApp(phones) {
+    const found = await Promise.race([
+        sock.onWhatsApp(...phones.map((phone) => `${phone}@s.whatsapp.net`)),
+        new Promise((_, reject) =>
+            setTimeout(() => reject(new Error('onWhatsApp lookup timeout')), ON_WHATSAPP_TIMEOUT_MS)
+        ),
+    ]);
+    const registered = new Set(
+        (found || []).filter((item) => item?.exists).map((item) => digitsOf(String(item.jid).split('@')[0]))
+    );
+    for (const phone of phones) {
+        rememberExistence(phone, registered.has(digitsOf(phone)));
+    }
+}
+
+// Resolves to { phone: true|false|null } (null when the lookup failed); served from
+// the cache where possible, with concurrent lookups for the same number shared.
+async function lookupNumbers(phones) {
+    const results = {};
+    const waiting = [];
+    const uncached = [];
+    for (const phone of new Set(phones.map(String))) {
+        const cached = getCachedExistence(phone);
+        if (cached !== undefined) {
+            results[phone] = cached;
+        } else if (existenceLookups.has(phone)) {
+            waiting.push(phone);
+        } else {
+            uncached.push(phone);
+        }
+    }
+
+    for (let i = 0; i < uncached.length; i += ON_WHATSAPP_CHUNK) {
+        const chunk = uncached.slice(i, i + ON_WHATSAPP_CHUNK);
+        const lookup = queryOnWhatsApp(chunk);
+        for (const phone of chunk) {
+            existenceLookups.set(phone, lookup);
+        }
+        waiting.push(...chunk);
+        lookup.catch(() => {}).finally(() => {
+            for (const phone of chunk) {
+                existenceLookups.delete(phone);
+            }
+        });
+    }
+
+    for (const phone of waiting) {
+        try {
+            await existenceLookups.get(phone);
+        } catch (e) {
+            console.error(`Lookup failed for ${phone}:`, e.message);
+        }
+        const cached = getCachedExistence(phone);
+        results[phone] = cached === undefined ? null : cached;
+    }
+    return results;
+}
+
+loadExistenceCache();
+
 async function connectToWhatsApp() {
     const { state, saveCreds } = await useMultiFileAuthState('auth_info_baileys');
     const { version, isLatest } = await fetchLatestBaileysVersion();
@@ -105,10 +245,36 @@ async function connectToWhatsApp() {
     });
 }
 
+function isAuthorized(req) {
+    const providedApiKey = (req.header('X-Api-Key') || '').trim();
+    return !WA_SERVICE_API_KEY || providedApiKey === WA_SERVICE_API_KEY;
+}
+
+// Sends one text message; resolves to the per-item result used by both endpoints.
+async function sendText(phone, message) {
+    const jid = `${phone}@s.whatsapp.net`;
+    const exists = (await lookupNumbers([phone]))[String(phone)];
+    if (exists === null) {
+        throw new Error('onWhatsApp lookup failed');
+    }
+
+    if (exists) {
+        await sock.sendMessage(jid, { text: message });
+        return { status: 'sent' };
+    }
+    return { status: 'error', status_code: 404, error: 'Number not registered on WhatsApp' };
+}
+
+// Readiness probe: 200 once WhatsApp is connected, 503 otherwise. Batch jobs call it
+// before sending so they can defer instead of collecting 503s message by message.
+app.get('/ready', (req, res) => {
+    const ready = Boolean(sock && isWhatsAppReady);
+    return res.status(ready ? 200 : 503).json({ ready });
+});
+
 // API Endpoint to send messages
 app.post('/send-message', async (req, res) => {
-    const providedApiKey = (req.header('X-Api-Key') || '').trim();
-    if (WA_SERVICE_API_KEY && providedApiKey !== WA_SERVICE_API_KEY) {
+    if (!isAuthorized(req)) {
         return res.status(401).json({ success: false, error: 'Unauthorized' });
     }
 
@@ -119,20 +285,94 @@ app.post('/send-message', async (req, res) => {
     }
 
     try {
-        const jid = `${phone}@s.whatsapp.net`;
-        const exists = await Promise.race([
-            sock.onWhatsApp(jid),
-            new Promise((_, reject) =>
-                setTimeout(() => reject(new Error('onWhatsApp lookup timeout')), 8000)
-            ),
-        ]);
-        
-        if (exists && exists[0]?.exists) {
-            await sock.sendMessage(jid, { text: message });
-            return res.json({ status: 'sent' });
-        } else {
-            return res.status(404).json({ error: 'Number not registered on WhatsApp' });
+        const result = await sendText(phone, message);
+        if (result.status === 'sent') {
+            return res.json(result);
+        }
+        return res.status(result.status_code).json({ error: result.error });
+    } catch (e) {
+        console.error(e);
+        return res.status(500).json({ error: e.message });
+    }
+});
+
+// Batch endpoint: { messages: [{ phone, message }], stopPhoneOnError } -> { results: [...] }
+// Each phone's messages are sent in order; different phones are sent in parallel.
+// With stopPhoneOnError, messages after a failed one to the same phone come back as 'skipped'.
+app.post('/send-batch', async (req, res) => {
+    if (!isAuthorized(req)) {
+        return res.status(401).json({ success: false, error: 'Unauthorized' });
+    }
+
+    const { messages, stopPhoneOnError } = req.body || {};
+    if (!Array.isArray(messages) || messages.length === 0 || messages.length > SEND_BATCH_MAX) {
+        return res.status(400).json({ error: `messages must be an array of 1-${SEND_BATCH_MAX} items` });
+    }
+
+    if (!sock || !isWhatsAppReady) {
+        return res.status(503).json({ error: 'WhatsApp not connected' });
+    }
+
+    const results = new Array(messages.length);
+    const byPhone = new Map();
+    messages.forEach((item, index) => {
+        const key = String(item?.phone || '');
+        if (!byPhone.has(key)) {
+            byPhone.set(key, []);
+        }
+        byPhone.get(key).push(index);
+    });
+    const pending = [...byPhone.values()];
+
+    async function drain() {
+        while (pending.length) {
+            const indexes = pending.shift();
+            let failed = false;
+            for (const index of indexes) {
+                const { phone, message } = messages[index] || {};
+                if (failed) {
+                    results[index] = { status: 'skipped' };
+                    continue;
+                }
+                if (!phone || !message) {
+                    results[index] = { status: 'error', status_code: 400, error: 'phone and message are required' };
+                } else {
+                    try {
+                        results[index] = await sendText(phone, message);
+                    } catch (e) {
+                        console.error(e);
+                        results[index] = { status: 'error', status_code: 500, error: e.message };
+                    }
+                }
+                if (stopPhoneOnError && results[index].status === 'error') {
+                    failed = true;
+                }
+            }
         }
+    }
+
+    const lanes = Math.max(1, Math.min(SEND_BATCH_CONCURRENCY, pending.length));
+    await Promise.all(Array.from({ length: lanes }, drain));
+    return res.json({ results });
+});
+
+// Pre-validates recipients: { phones: [...] } -> { results: { phone: true|false|null } }
+app.post('/lookup-batch', async (req, res) => {
+    if (!isAuthorized(req)) {
+        return res.status(401).json({ success: false, error: 'Unauthorized' });
+    }
+
+    const { phones } = req.body || {};
+    if (!Array.isArray(phones) || phones.length === 0 || phones.length > LOOKUP_BATCH_MAX) {
+        return res.status(400).json({ error: `phones must be an array of 1-${LOOKUP_BATCH_MAX} numbers` });
+    }
+
+    if (!sock || !isWhatsAppReady) {
+        return res.status(503).json({ error: 'WhatsApp not connected' });
+    }
+
+    try {
+        return res.json({ results: await lookupNumbers(phones) });
     } catch (e) {
         console.error(e);
         return res.status(500).json({ error: e.message });